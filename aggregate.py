@@ -8,22 +8,30 @@ import pandas as pd
 import argparse
 import collections
 import datetime
-import dateutil
 import subprocess
-import inspect
+import multiprocessing
 import os
 import time
 import csv
-from collections import defaultdict, Counter
+import pickle
+import hashlib
+import resource
+import tracemalloc
+import cProfile
+import sqlite3
+from collections import Counter
 from subjects import get_subjects_df
+import dates
 
 #For debugging
 #pd.set_option('display.max_columns', None)
 #pd.set_option('display.max_rows', None)
 #pd.set_option('display.expand_frame_repr', None)
 
-bad = defaultdict(int) #Keys of bad are indices of rows in the final dataframe
-autoresolved = {} #Keys of autoresolved are indices of rows in the final dataframe
+#Indices of the rows with unresolved and autoresolved fields in the workflow currently being resolved.
+#resolve_workflow turns these into boolean columns, which main() assembles into rows x workflows matrices.
+bad = set()
+autoresolved = set()
 
 #Columns to use in all cases, with the rules for reading them in
 KEYS = ['subject_id', 'task']
@@ -34,6 +42,18 @@ KEYS_DTYPES = {'subject_id': int}
 KEYS_CONVERTERS_2 = {}
 KEYS_DTYPES_2 = {'subject_id': int, 'task': int}
 
+RETIREMENT_COUNT = 3 #I believe that this is the same for all workflows at all times. Can be parameterised in workflows.yaml if need be.
+
+#Column holding the decoded form of data.aligned_text (see decode_literals)
+DECODED = 'data.aligned_text.decoded'
+#Bump these if the structure of the literals or views sidecar changes, so that old sidecars are ignored
+LITERALS_CACHE_VERSION = 1
+VIEWS_CACHE_VERSION = 1
+#Bump this if the --state store's schema or the meaning of its contents changes, so that old stores are rebuilt
+STATE_VERSION = 1
+#Rows per chunk when streaming through the extraction files in count_text_views
+VIEWS_CHUNK_ROWS = 1 << 18
+
 parser = argparse.ArgumentParser()
 parser.add_argument('workflow_set',
                     help = 'Label for set of workflows to process. See workflow.yaml. "phase1" and "phase2" are good values.')
@@ -61,6 +81,18 @@ parser.add_argument('--dropdown_threshold', '-d',
                     type = float,
                     default = 0.66,
                     help = 'Dropdown consensus threshold, from 0 to 1. This is used for all "non-text" fields, so applies to dates and numbers as well as dropdowns. (Default: 0.66)')
+parser.add_argument('--threshold_sweep',
+                    type = float,
+                    nargs = '+',
+                    metavar = 'T',
+                    help = ('Instead of producing output, resolve the data at each of the given text thresholds and report the rows and fields that joined.csv would have at each: how many rows, how many of them have unresolved fields, only blanks or no problems, and how many fields are unresolved and autoresolved. '
+                            'The data is read only once. The report goes to stdout and to threshold_sweep.csv in the output directory.')
+                   )
+parser.add_argument('--dropdown_sweep',
+                    type = float,
+                    nargs = '+',
+                    metavar = 'D',
+                    help = 'With --threshold_sweep, the dropdown thresholds to try, in combination with each text threshold (default: just --dropdown_threshold)')
 parser.add_argument('--unfinished', '-u',
                     action = 'store_true',
                     help = 'Include classifications with insufficient number of views and pages with incomplete or missing rows')
@@ -69,7 +101,10 @@ parser.add_argument('--uncertainty',
                     help = 'Treat certain patterns as indicating presence of an uncertain transcription and requiring manual review. May result in a lot of additional manual work as this is a pre-reconciliation check: reconciled algorithms may reconcile-out the uncertainty markers. The script always flags similar patterns in reconciled strings: this is less work to clean up but relies upon believing that auto-reconciliation has coped OK with uncertainty markers in the original transcriptions.')
 parser.add_argument('--no_transcriptionisms',
                     action = 'store_true',
-                    help = 'Skip "always on" post-reconciliation check for patterns indicating transcription uncertainty. This saves a lot of time so can be helpful in development.')
+                    help = 'Skip "always on" post-reconciliation check for patterns indicating transcription uncertainty.')
+parser.add_argument('--unresolved_column',
+                    action = 'store_true',
+                    help = 'Add an "Unresolved" column after "Autoresolved", listing the fields in each row that could not be resolved, or that the post-reconciliation check flagged for transcription uncertainty.')
 parser.add_argument('--no_stamp', '-S',
                     action = 'store_true',
                     help = 'Do not stamp the output with information about the script used to generate it')
@@ -79,50 +114,196 @@ parser.add_argument('--verbose', '-v',
                     help = 'Set to higher numbers for increasing verbosity')
 parser.add_argument('--timing',
                     action = 'store_true',
-                    help = 'Give timing information for phases in the program')
+                    help = 'Give timing information for phases in the program, and write a profile of each phase (time, memory, rows) to profile.json in the output directory')
+parser.add_argument('--tracemalloc',
+                    action = 'store_true',
+                    help = 'With --timing, also record the peak Python memory allocation in each phase. Slows the program down considerably.')
+parser.add_argument('--cprofile',
+                    action = 'store_true',
+                    help = 'With --timing, also run each phase under cProfile and dump the stats to the cprofile directory in the output directory')
 parser.add_argument('--flow_report', '-f',
                     action = 'store_true',
                     help = ('Show information about paths taken through program.\n'
-                            'Used in conjunction with coverage.sh to make sure that test inputs are testing all paths.'
+                            'See also --flow_counts, which is much cheaper on large inputs.'
                            )
                    )
+parser.add_argument('--flow_counts',
+                    metavar = 'FILE',
+                    help = ('Count the paths taken through program, per workflow, and write the counts to FILE as JSON.\n'
+                            'Used by testing/coverage.pl to make sure that test inputs are testing all paths.'
+                           )
+                   )
+parser.add_argument('--flow_samples',
+                    type = int,
+                    default = 0,
+                    metavar = 'N',
+                    help = 'With --flow_counts, also record the ids of the first N rows to take each path (default: 0)')
+parser.add_argument('--no_cache', '--no_literals_cache',
+                    action = 'store_true',
+                    help = 'Do not read or write the caches of decoded reducer literals and of view counts (the *.literals.pickle and *.views.pickle files next to the reducer and extractor files)')
+parser.add_argument('--state',
+                    metavar = 'FILE',
+                    help = ('SQLite file in which to keep the resolution of every cell between runs. '
+                            'On the next run, only cells whose reduced data or view count has changed are resolved again. '
+                            'The file is created if it does not exist. Resolutions made with different thresholds or options are not reused.')
+                   )
 parser.add_argument('--dump_interims',
                     action = 'store_true',
                     help = 'Dump out CSV files at intermediate stages of processing. Helpful for testing and debugging.')
+parser.add_argument('--jobs', '-j',
+                    type = int,
+                    default = 1,
+                    help = 'Number of workflows to resolve in parallel (default: 1). Output is the same as for a serial run, but --flow_report and --verbose output may be reordered.')
 parser.add_argument('--row_factor',
                     type = float,
                     help = 'Percentage of total rows to read. Repeatable across runs, for faster testing cycles.'
                    )
 args = parser.parse_args()
 
+#Flow points reached, keyed by (flow id, workflow name), and sample row ids for each
+FLOWS = args.flow_report or args.flow_counts
+flow_counts = Counter()
+flow_samples = collections.defaultdict(list)
+
 def dump_interim(pandas_thing, fnam):
   if args.dump_interims:
     fnam = re.compile(r'[ \(\)/]').sub('_', fnam)
     pandas_thing.to_csv(f'{args.output_dir}/interims/{fnam}.csv')
 
-def flow_report(msg, row_id, value):
-  if not args.flow_report: return
+#flow_id is a static string: '<function> <path>', as listed in testing/coverage.pl
+def flow_report(flow_id, row_id, value):
+  if not FLOWS: return
 
-  caller = inspect.stack()[1]
-  try: report_id = f'{caller.function} {msg}'
-  finally: del caller
-  if args.verbose >= 1:
-    print(f'FR: {report_id} {row_id} {value}')
-  else:
-    if report_id not in flow_report.reported:
-      flow_report.reported.add(report_id)
-      print(f'FR: {report_id}')
+  flow_tally(flow_id, [row_id])
+  if args.flow_report:
+    if args.verbose >= 1:
+      line = f'FR: {flow_id} {row_id} {value}'
+    else:
+      if flow_id in flow_report.reported: return
+      flow_report.reported.add(flow_id)
+      line = f'FR: {flow_id}'
+    if flow_report.messages is None: print(line)
+    else: flow_report.messages.append((flow_id, line))
 flow_report.reported = set()
-
-def track(msg, **kwargs):
+flow_report.workflow = None #Name of the workflow currently being resolved
+flow_report.messages = None #In a --jobs worker, the lines to report as (flow_id, line), for main to print (see print_flow_messages)
+
+#Print the lines that flow_report collected in a --jobs worker, as flow_report would have printed them in a serial run
+def print_flow_messages(messages):
+  for flow_id, line in messages:
+    if args.verbose >= 1 or flow_id not in flow_report.reported:
+      flow_report.reported.add(flow_id)
+      print(line)
+
+#Count a flow point for each of row_ids, without printing anything
+def flow_tally(flow_id, row_ids):
+  if not FLOWS or len(row_ids) == 0: return #An empty tally would count as the path having been taken
+  key = (flow_id, flow_report.workflow)
+  flow_counts[key] += len(row_ids)
+  if len(flow_samples[key]) < args.flow_samples:
+    flow_samples[key].extend(row_ids[:args.flow_samples - len(flow_samples[key])])
+
+def dump_flow_counts():
+  result = {}
+  for (flow_id, workflow_name), count in sorted(flow_counts.items(), key = lambda x: (x[0][0], str(x[0][1]))):
+    entry = {'count': count}
+    if args.flow_samples: entry['samples'] = [list(x) for x in flow_samples[(flow_id, workflow_name)]]
+    result.setdefault(flow_id, {})[workflow_name] = entry
+  with open(args.flow_counts, 'w') as f:
+    json.dump(result, f, indent = 2, default = int) #default converts numpy ints in the row ids
+
+#A stage runs from one call to track (or track_start) to the next, and is named by the later call.
+#With --timing, each stage is recorded in track.stages, which main() writes to profile.json:
+#wall and CPU time, the peak RSS of the process so far and how much the stage raised it,
+#optionally peak Python allocation during the stage, and the number of rows going in and out
+#(where the caller passes rows). ru_maxrss is a high-water mark for the whole life of the process,
+#so it cannot give a stage's own peak: a stage that stays below an earlier peak raises it by 0.
+def track_start(workflow_name = None, rows = None):
+  if not args.timing: return
+  track.workflow = workflow_name
+  track.rows = rows
+  track.wall = time.perf_counter()
+  track.cpu = time.process_time()
+  track.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if args.tracemalloc:
+    if not tracemalloc.is_tracing(): tracemalloc.start()
+    tracemalloc.reset_peak()
+    track.traced = tracemalloc.get_traced_memory()[0]
+  if args.cprofile: track.profiler.enable()
+
+def track(msg, rows = None, regardless = False):
   if args.timing:
-    now = time.time()
-    if track.last == 0: track.last = now
-    print(f'[{int(now - track.last):>5n}] {msg}')
-    track.last = now
-  elif 'regardless' in kwargs and kwargs['regardless']:
+    wall = time.perf_counter() - track.wall
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stage = {
+      'workflow': track.workflow,
+      'stage': msg.strip(' *'),
+      'wall': wall,
+      'cpu': time.process_time() - track.cpu,
+      'process_peak_rss_kib': rss,
+      'peak_rss_growth_kib': rss - track.rss,
+      'rows_in': track.rows,
+      'rows_out': rows,
+    }
+    if args.tracemalloc: stage['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1] - track.traced
+    if args.cprofile:
+      track.profiler.disable()
+      fnam = re.compile(r'[ \(\)/:"]').sub('_', f'{len(track.stages):02}_{stage["stage"]}')
+      track.profiler.dump_stats(f'{args.output_dir}/cprofile/{fnam}.pstats')
+      track.profiler.clear()
+    track.stages.append(stage)
+    print(f'[{int(wall):>5n}] {msg}')
+    track_start(track.workflow, rows if rows is not None else track.rows)
+  elif regardless:
     print(msg)
-track.last = 0
+track.stages = []
+if args.timing and args.cprofile: track.profiler = cProfile.Profile()
+track_start()
+
+def file_hash(fnam):
+  digest = hashlib.sha256()
+  with open(fnam, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''): digest.update(block)
+  return digest.hexdigest()
+
+#The reducer stores data.aligned_text (text) and data.value (dropdown) as Python literals.
+#Decode each distinct literal in the given columns exactly once and return a dict of decoded Series, indexed as df.
+#The decoded literals are cached in a binary sidecar next to the reducer file, keyed on the hash of the reducer file,
+#so repeat runs (e.g. with different thresholds) skip the parsing entirely. A stale sidecar is just overwritten.
+#The decoded values may be shared between cells, so callers must not modify them in place.
+def decode_literals(reduced_file, df, cols):
+  sidecar = f'{os.path.splitext(reduced_file)[0]}.literals.pickle'
+  digest = file_hash(reduced_file)
+  literals = None
+  cached = read_sidecar(sidecar, LITERALS_CACHE_VERSION, digest)
+  if cached is not None and set(cols) <= set(cached['literals']):
+    literals = cached['literals']
+  if literals is None:
+    literals = {c: {x: ast.literal_eval(x) for x in df[c].dropna().unique()} for c in cols}
+    write_sidecar(sidecar, LITERALS_CACHE_VERSION, digest, literals = literals)
+  elif args.verbose >= 2: print(f'  Using cached literals from {sidecar}')
+  return {c: df[c].map(literals[c].__getitem__, na_action = 'ignore') for c in cols}
+
+#Caches of work derived from input files live in pickled sidecars next to those files.
+#Each records a format version and a hash of its inputs, and only counts if both still match.
+#Return the cached dict, or None if there is no usable cache.
+def read_sidecar(sidecar, version, digest):
+  if args.no_cache or not os.path.exists(sidecar): return None
+  try:
+    with open(sidecar, 'rb') as f: cached = pickle.load(f)
+    if cached['version'] == version and cached['hash'] == digest: return cached
+  except Exception as e: #A broken cache is never fatal, we just regenerate it
+    print(f'  Warning: ignoring unreadable cache {sidecar} ({e})', file = sys.stderr)
+  return None
+
+def write_sidecar(sidecar, version, digest, **payload):
+  if args.no_cache: return
+  try: #Write then rename, so that concurrent runs never see a partial sidecar
+    with open(f'{sidecar}.{os.getpid()}', 'wb') as f:
+      pickle.dump({'version': version, 'hash': digest, **payload}, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(f'{sidecar}.{os.getpid()}', sidecar)
+  except OSError as e: #e.g. read-only extraction dir
+    print(f'  Warning: could not write cache {sidecar} ({e})', file = sys.stderr)
 
 #Candidates is a list of strings
 #Each string shoud correspond to a single text box from the workflows
@@ -185,30 +366,53 @@ def count_text_views(wid):
   #(Alternative implementation: we could identify finished subjects by looking at 'retired' in the subject metadata logged in the exports file, and then perhaps the 'already_seen' flag in there can be used to catch repeat classifications -- depending upon exactly what that flag means. That is likely to be more simple and more efficient.)
   #This is only needed for TEXT_T, as the dropdown reducer does give us a count of all votes, even where the volunteer did not vote (logged as a vote for None)
   #We also take the opportunity to log cases where a logged-in user has classified the same subject more than once (we could try to do this for anonymous users as well, but I'm not sure about the IP hashes)
-  extractor_df = pd.read_csv(args.dir + '/' + f'text_extractor_{wid}.csv',
-                          index_col = KEYS, #i.e. subject_id and task, so that we are indexed the same way as the data
-                          usecols = KEYS + ['classification_id', 'user_id'], #classification_id MUST be present, so we can use to count the total. user_id needed for counting logged-in users.
-                          converters = KEYS_CONVERTERS,
-                          dtype = { **KEYS_DTYPES, 'classification_id': int, 'user_id': float } #user_id is float so that blanks can be NaN
-                         )
-
-  #Sanity check -- the uncleaned (but tranche-and-volume-processed) extraction file should contain the same classification ids
-  extractor_vols_series = pd.read_csv(args.dir + '/' + f'text_extractor_{wid}.vols.csv', index_col = KEYS, usecols = KEYS + ['classification_id'], converters = KEYS_CONVERTERS, dtype = {**KEYS_DTYPES, 'classification_id': int})['classification_id']
-  assert len(extractor_vols_series) == len(extractor_df['classification_id'])
-  extractor_vols_series_comparison = extractor_vols_series.reset_index(drop = True).eq(extractor_df['classification_id'].reset_index(drop = True))
-  assert extractor_vols_series_comparison.all(), extractor_vols_series_comparison
-
-  #First work out whether logged in users have performed repeat classifications on any subjects, so that we can log that this has happened
+  #The extraction files can be large, so we stream through them in chunks, keeping only running counts.
+  #The counts depend only on the extraction files, so are cached next to them, keyed on their hashes.
+  extractor_file = f'{args.dir}/text_extractor_{wid}.csv'
+  vols_file = f'{args.dir}/text_extractor_{wid}.vols.csv'
+  sidecar = f'{os.path.splitext(extractor_file)[0]}.views.pickle'
+  digest = (file_hash(extractor_file), file_hash(vols_file))
+  cached = read_sidecar(sidecar, VIEWS_CACHE_VERSION, digest)
+  if cached is not None:
+    if args.verbose >= 2: print(f'  Using cached view counts from {sidecar}')
+    return (cached['raw_count'], cached['nonunique_views'])
+
+  extractor_chunks = pd.read_csv(extractor_file,
+                                 usecols = KEYS + ['classification_id', 'user_id'], #classification_id MUST be present, so we can use to count the total. user_id needed for counting logged-in users.
+                                 converters = KEYS_CONVERTERS,
+                                 dtype = { **KEYS_DTYPES, 'classification_id': int, 'user_id': float }, #user_id is float so that blanks can be NaN
+                                 chunksize = VIEWS_CHUNK_ROWS)
+  vols_chunks = pd.read_csv(vols_file, usecols = ['classification_id'], dtype = {'classification_id': int}, chunksize = VIEWS_CHUNK_ROWS)
+
+  raw_count = None  #rows per (subject_id, task)
+  user_count = None #rows per (subject_id, task, user_id), for logged-in users
+  for extractor_chunk in extractor_chunks:
+    #Sanity check -- the uncleaned (but tranche-and-volume-processed) extraction file should contain the same classification ids
+    vols_chunk = next(vols_chunks, None)
+    assert vols_chunk is not None and len(vols_chunk) == len(extractor_chunk), f'{vols_file} is shorter than {extractor_file}'
+    comparison = vols_chunk['classification_id'].reset_index(drop = True).eq(extractor_chunk['classification_id'].reset_index(drop = True))
+    assert comparison.all(), comparison
+
+    chunk_count = extractor_chunk.groupby(KEYS).size()
+    raw_count = chunk_count if raw_count is None else raw_count.add(chunk_count, fill_value = 0)
+    chunk_users = extractor_chunk.dropna(subset = ['user_id']).groupby(KEYS + ['user_id']).size()
+    user_count = chunk_users if user_count is None else user_count.add(chunk_users, fill_value = 0)
+  assert next(vols_chunks, None) is None, f'{vols_file} is longer than {extractor_file}'
+  if raw_count is None: raise Exception(f'{extractor_file} is empty')
+  raw_count = raw_count.astype(int).sort_index().rename('classification_id')
+
+  #Work out whether logged in users have performed repeat classifications on any subjects, so that we can log that this has happened
+  #This is the count of classifications minus the number of unique users, entirely ignoring anonymous users, as we can't necessarily rely on the IP address
   nonunique_views = None
-  id_group = extractor_df['user_id'].groupby(KEYS) #for user_id-aware counting
-  repeat_classifications = id_group.count() - id_group.nunique() #entirely ignoring nans (these functions ignore them), as we can't necessarily rely on the IP address so we want to set aside anonymous users here
+  id_group = user_count.sort_index().groupby(KEYS)
+  repeat_classifications = (id_group.sum() - id_group.size()).astype(int)
   repeat_classifications = repeat_classifications[repeat_classifications != 0]
   if len(repeat_classifications) != 0:
     subj_group = repeat_classifications.groupby('subject_id')
     assert subj_group.nunique().eq(1).all() #Each task within a given subject should have the same number of classifications
     nonunique_views = subj_group.first() #This is storing the raw count minus the unique count for every repeat-classified subject in the current field
 
-  raw_count = extractor_df['classification_id'].groupby(KEYS).count() #counts all rows
+  write_sidecar(sidecar, VIEWS_CACHE_VERSION, digest, raw_count = raw_count, nonunique_views = nonunique_views)
   return (raw_count, nonunique_views)
 
 
@@ -228,8 +432,7 @@ def category_resolver(candidates, threshold, subject_task, workflow_name):
     if votes == total_votes:
       return {selection: votes}
     if votes / total_votes >= threshold: #data has been autoresolved
-      if subject_task in autoresolved: autoresolved[subject_task][workflow_name] = None
-      else: autoresolved[subject_task] = { workflow_name: None }
+      autoresolved.add(subject_task)
       return {selection: votes}
   return candidates
 
@@ -241,28 +444,28 @@ def years_at_sea_resolver(candidates, row, data, datacol):
   merchants = []
 
   if uncertainty(originals):
-    flow_report('Uncertain transcriber', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
+    flow_report('years_at_sea_resolver Uncertain transcriber', row.name, row['data.aligned_text'])
+    bad.add(row.name)
     return pretty_candidates(candidates, row['data.consensus_text'])
 
   for numbers in [x.split(';') for x in originals]:
     if len(numbers) != 2:
-      flow_report('Wrong number of "years at sea" entries (or bad separator)', row.name, originals)
-      bad[row.name] += 1
+      flow_report('years_at_sea_resolver Wrong number of "years at sea" entries (or bad separator)', row.name, originals)
+      bad.add(row.name)
       return pretty_candidates(candidates, row['data.consensus_text'])
     try:
       (navy, merchant) = [float(x) for x in numbers]
     except ValueError:
-      flow_report('Non-float argument in "years at sea"', row.name, originals)
-      bad[row.name] += 1
+      flow_report('years_at_sea_resolver Non-float argument in "years at sea"', row.name, originals)
+      bad.add(row.name)
       return pretty_candidates(candidates, row['data.consensus_text'])
     navies.append(navy)
     merchants.append(merchant)
   navy_results     = category_resolver(collections.Counter(navies),    args.dropdown_threshold, row.name, data['name'])
   merchant_results = category_resolver(collections.Counter(merchants), args.dropdown_threshold, row.name, data['name'])
   if len(navy_results) == 1 and len(merchant_results) == 1:
-    if row.name in autoresolved and data['name'] in autoresolved[row.name]: flow_report('Autoresolved', row.name, originals)
-    else: flow_report('Unanimous', row.name, originals)
+    if row.name in autoresolved: flow_report('years_at_sea_resolver Autoresolved', row.name, originals)
+    else: flow_report('years_at_sea_resolver Unanimous', row.name, originals)
     navy_result = "%02g" % next(iter(navy_results))
     merchant_result = "%02g" % next(iter(merchant_results))
     navy_result=re.sub('^\d\.', '0\g<0>', navy_result)
@@ -271,80 +474,170 @@ def years_at_sea_resolver(candidates, row, data, datacol):
   else:
     #Because we resolve the two sides independently, we might both autoresolve and fail for the field.
     #This is a bit confusing, so if we failed for either side, remove the autoresolved.
-    if row.name in autoresolved and data['name'] in autoresolved[row.name]: del autoresolved[row.name][data['name']]
+    autoresolved.discard(row.name)
 
-    if len(navy_results) != 1 and len(merchant_results) != 1: flow_report('Unresolvable (both sides)', row.name, originals)
-    elif len(navy_results) != 1: flow_report('Unresolvable (navy side)', row.name, originals)
-    else: flow_report('Unresolvable (merchant side)', row.name, originals)
-    bad[row.name] += 1
+    if len(navy_results) != 1 and len(merchant_results) != 1: flow_report('years_at_sea_resolver Unresolvable (both sides)', row.name, originals)
+    elif len(navy_results) != 1: flow_report('years_at_sea_resolver Unresolvable (navy side)', row.name, originals)
+    else: flow_report('years_at_sea_resolver Unresolvable (merchant side)', row.name, originals)
+    bad.add(row.name)
     return pretty_candidates(candidates, row['data.consensus_text'])
 
-def string_resolver(row, data, datacol):
-  if uncertainty(unaligned(ast.literal_eval(row['data.aligned_text']))):
-    flow_report('Uncertain transcriber', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
-    return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
-  if row['data.consensus_score'] / row['data.number_views'] < args.text_threshold:
-    flow_report('Did not pass threshold', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
-    return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+#Receive the decoded dropdown reductions: a Series of single-element lists, each containing a dict of option -> votes
+#Return the votes in long form: a DataFrame with the same index, repeated once per option, and columns 'option' and 'votes'.
+#Options stay in their original order within each row, as category_resolver would see them.
+def dropdown_votes(decoded):
+  if not decoded.str.len().eq(1).all(): raise Exception()
+  selections = decoded.str[0]
+  return pd.DataFrame({'option': [k for x in selections for k in x.keys()],
+                       'votes':  [v for x in selections for v in x.values()]},
+                      index = selections.index.repeat(selections.str.len()))
+
+#Compile a Task_labels file into a Series mapping (task, option) to the label shown to transcribers.
+#The file has keys such as 'T1.selects.0.options.*.14.label', each mapping to a single-entry dict of {id: label}.
+#Labels may start with an abbreviation and '=', which we drop.
+def compile_task_labels(labelfile):
+  with open(labelfile) as f:
+    labels = yaml.full_load(f)
+  pattern = re.compile(r'T(\d+)\.selects\.0\.options\.\*\.([^.]+)\.label')
+  table = {}
+  for key, value in labels.items():
+    match = pattern.fullmatch(key)
+    if not match: continue
+    label_list = list(value.values())
+    if len(label_list) != 1: raise Exception('\n'.join(['Assumption that label_list always contains 1 element is broken'] + label_list))
+    label = label_list[0]
+    table[(int(match.group(1)), match.group(2))] = label[label.find('=') + 1:].strip()
+  return pd.Series(table, dtype = object).rename_axis(['task', 'option'])
+
+#Resolves a whole dropdown column at once, from the long-form votes produced by dropdown_votes.
+#Follows category_resolver: the first option (in row order) with all of the votes, or with at least
+#the threshold proportion of them, wins. Winners are replaced by their labels. Rows without a winner
+#are bad, and get all of their labelled candidates formatted for manual resolution.
+#Returns the resolved column, indexed as df.
+def drop_resolver(df, data, datacol, votes, labels):
+  votes = votes[votes.index.isin(df.index)].copy()
+  votes['total'] = votes.groupby(level = KEYS, sort = False)['votes'].transform('sum')
+  label_keys = pd.MultiIndex.from_arrays([votes.index.get_level_values('task'), votes['option']])
+  votes['label'] = labels.reindex(label_keys).values
+  unlabelled = votes['label'].isnull() & votes['option'].ne('None')
+  if unlabelled.any(): raise Exception(f'No label for options:\n{votes[unlabelled]}')
+  votes.loc[votes['option'].eq('None'), 'label'] = None
+
+  winners = votes[votes['votes'].eq(votes['total']) | (votes['votes'] / votes['total'] >= args.dropdown_threshold)]
+  winners = winners[~winners.index.duplicated()]
+  resolved = pd.Series(df.index.isin(winners.index), index = df.index)
+  autos = pd.Series(df.index.isin(winners.index[winners['votes'].ne(winners['total'])]), index = df.index)
+
+  if args.flow_report: #Report in row order, so that verbose output matches the per-row resolvers
+    for idx, value in df[datacol].items():
+      if not resolved[idx]: flow_report('drop_resolver Unresolvable', idx, value)
+      elif autos[idx]:      flow_report('drop_resolver Autoresolved', idx, value)
+      else:                 flow_report('drop_resolver Unanimous', idx, value)
+  elif FLOWS:
+    flow_tally('drop_resolver Unresolvable', df.index[~resolved])
+    flow_tally('drop_resolver Autoresolved', df.index[autos])
+    flow_tally('drop_resolver Unanimous', df.index[resolved & ~autos])
+
+  autoresolved.update(df.index[autos])
+  bad_idx = df.index[~resolved]
+  bad.update(bad_idx)
+
+  result = pd.Series(None, index = df.index, dtype = object)
+  result.loc[winners.index] = winners['label'].values
+  if len(bad_idx):
+    bad_votes = votes[votes.index.isin(bad_idx)]
+    candidates = {k: dict(zip(g['label'], g['votes'])) for k, g in bad_votes.groupby(level = KEYS, sort = False)}
+    result.loc[bad_idx] = [pretty_candidates(candidates.get(x, {})) for x in bad_idx]
+  return result
+
+#Resolves a whole string column at once, rather than row-by-row via text_resolver.
+#The threshold test, null-views blanking and autoresolved/bad marking are all done as array operations.
+#Only the cells that end up bad need per-cell work, to format their candidates for manual resolution.
+#Returns the resolved column, indexed as df.
+def string_resolver(df, data, datacol):
+  #This means either that no-one has classified it, or that all classifications were empty strings
+  #Either way, return a blank (see text_resolver)
+  unviewed = df['data.number_views'].isnull()
+  if (unviewed & df['data.consensus_score'].notnull()).any(): raise Exception('Broken assumption')
+  viewed_df = df[~unviewed]
+
+  if args.uncertainty:
+    uncertain = viewed_df[DECODED].map(lambda x: uncertainty(unaligned(x))).astype(bool)
   else:
-    if row['data.consensus_score'] != row['data.number_views']: #data has been autoresolved (ignoring any empty strings)
-      if row.name in autoresolved:
-        flow_report('Later autoresolve', row.name, row['data.aligned_text'])
-        autoresolved[row.name][data['name']] = None
-      else:
-        flow_report('First autoresolve', row.name, row['data.aligned_text'])
-        autoresolved[row.name] = { data['name']: None }
-    else: flow_report('Unambiguous', row.name, row['data.aligned_text'])
-    return row[datacol]
+    uncertain = pd.Series(False, index = viewed_df.index)
+  failed = ~uncertain & (viewed_df['data.consensus_score'] / viewed_df['data.number_views'] < args.text_threshold)
+  passed = ~(uncertain | failed)
+  autos = passed & (viewed_df['data.consensus_score'] != viewed_df['data.number_views']) #data has been autoresolved (ignoring any empty strings)
+
+  if args.flow_report: #Report in row order, so that verbose output matches the per-row resolvers
+    for idx, aligned_text in viewed_df['data.aligned_text'].items():
+      if uncertain[idx]:     flow_report('string_resolver Uncertain transcriber', idx, aligned_text)
+      elif failed[idx]:      flow_report('string_resolver Did not pass threshold', idx, aligned_text)
+      elif autos[idx]:       flow_report('string_resolver Autoresolved', idx, aligned_text)
+      else:                  flow_report('string_resolver Unambiguous', idx, aligned_text)
+  elif FLOWS:
+    flow_tally('string_resolver Uncertain transcriber', viewed_df.index[uncertain])
+    flow_tally('string_resolver Did not pass threshold', viewed_df.index[failed])
+    flow_tally('string_resolver Autoresolved', viewed_df.index[autos])
+    flow_tally('string_resolver Unambiguous', viewed_df.index[passed & ~autos])
+
+  autoresolved.update(autos[autos].index)
+  bad_idx = viewed_df.index[~passed]
+  bad.update(bad_idx)
+
+  result = df[datacol].copy()
+  result.loc[unviewed] = ''
+  if len(bad_idx):
+    bad_df = viewed_df.loc[bad_idx]
+    result.loc[bad_idx] = [pretty_candidates(a, c) for a, c in zip(bad_df[DECODED], bad_df['data.consensus_text'])]
+  return result
 
 def date_resolver(row, data):
-    candidates = ast.literal_eval(row['data.aligned_text'])
+    candidates = row[DECODED]
 
     if(len(candidates) != 1): #Not a conventional case, resolve manually
-      flow_report('Surprising input', row.name, row['data.aligned_text'])
-      bad[row.name] += 1
-      return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+      flow_report('date_resolver Surprising input', row.name, row['data.aligned_text'])
+      bad.add(row.name)
+      return pretty_candidates(row[DECODED], row['data.consensus_text'])
 
     candidates = candidates[0]
 
     if uncertainty(candidates):
-      flow_report('Uncertain transcriber', row.name, row['data.aligned_text'])
-      bad[row.name] += 1
-      return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+      flow_report('date_resolver Uncertain transcriber', row.name, row['data.aligned_text'])
+      bad.add(row.name)
+      return pretty_candidates(row[DECODED], row['data.consensus_text'])
 
     #Check the candidates for any with a zero-field. Pass through for manual check if this happens.
     for x in candidates:
       parts = [int(y) for y in re.split(r'[-/\.]', x)]
       if len(parts) != 3 or 0 in parts:
-        flow_report('Zero-field (or bad field count)', row.name, row['data.aligned_text'])
-        bad[row.name] += 1
-        return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+        flow_report('date_resolver Zero-field (or bad field count)', row.name, row['data.aligned_text'])
+        bad.add(row.name)
+        return pretty_candidates(row[DECODED], row['data.consensus_text'])
 
     #https://stackoverflow.com/a/18029112 has a trick for reading arbitrary date formats while rejecting ambiguous cases
     #We just need to use the documented format, but we can be a bit forgiving
     #TODO: Improve date handling, see https://github.com/nationalarchives/hms-nhs-scripts/issues/11
     #TODO: This seems a bit redundant with data cleaning, might be able to make this bit faster by skipping the date parsing.
     try:
-      candidates = [dateutil.parser.parse(d, dayfirst = True) for d in candidates] #yearfirst defaults to False
+      candidates = [dates.parse_date(d) for d in candidates]
     except (TypeError, ValueError): #Something is wrong, resolve manually
-      flow_report('Unparseable', row.name, row['data.aligned_text'])
-      bad[row.name] += 1
-      return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+      flow_report('date_resolver Unparseable', row.name, row['data.aligned_text'])
+      bad.add(row.name)
+      return pretty_candidates(row[DECODED], row['data.consensus_text'])
     candidates = category_resolver(collections.Counter(candidates), args.dropdown_threshold, row.name, data['name'])
     if len(candidates) == 1:
-      if row.name in autoresolved and data['name'] in autoresolved[row.name]: flow_report('Autoresolved', row.name, row['data.aligned_text'])
-      else: flow_report('Unanimous', row.name, row['data.aligned_text'])
+      if row.name in autoresolved: flow_report('date_resolver Autoresolved', row.name, row['data.aligned_text'])
+      else: flow_report('date_resolver Unanimous', row.name, row['data.aligned_text'])
       date = next(iter(candidates))
-      return date.strftime('%b %d %Y')
+      return dates.format_resolved(date)
     else:
-      flow_report('Unresolvable', row.name, row['data.aligned_text'])
-      bad[row.name] += 1
-      return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+      flow_report('date_resolver Unresolvable', row.name, row['data.aligned_text'])
+      bad.add(row.name)
+      return pretty_candidates(row[DECODED], row['data.consensus_text'])
 
 def number_resolver(row, data, datacol):
-  candidates = ast.literal_eval(row['data.aligned_text'])
+  candidates = row[DECODED]
 
   #years at sea needs some special handling
   #it contains two floating point numbers, separated by a semicolon
@@ -353,44 +646,43 @@ def number_resolver(row, data, datacol):
     return years_at_sea_resolver(candidates, row, data, datacol)
 
   if(len(candidates) != 1): #Not a conventional case, resolve manually
-    flow_report('Surprising input', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
-    return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+    flow_report('number_resolver Surprising input', row.name, row['data.aligned_text'])
+    bad.add(row.name)
+    return pretty_candidates(row[DECODED], row['data.consensus_text'])
 
   candidates = candidates[0]
 
   if uncertainty(candidates):
-    flow_report('Uncertain transcriber', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
-    return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+    flow_report('number_resolver Uncertain transcriber', row.name, row['data.aligned_text'])
+    bad.add(row.name)
+    return pretty_candidates(row[DECODED], row['data.consensus_text'])
 
   #If there are any non-numerals in the input, just return it to resolve manually
   try:
     candidates = [float(x) for x in candidates]
   except ValueError:
-    flow_report('Non-float input', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
-    return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+    flow_report('number_resolver Non-float input', row.name, row['data.aligned_text'])
+    bad.add(row.name)
+    return pretty_candidates(row[DECODED], row['data.consensus_text'])
   if not all([x.is_integer() for x in candidates]):
-    flow_report('Non-integer input', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
-    return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+    flow_report('number_resolver Non-integer input', row.name, row['data.aligned_text'])
+    bad.add(row.name)
+    return pretty_candidates(row[DECODED], row['data.consensus_text'])
   candidates = [int(x) for x in candidates]
   candidates = category_resolver(collections.Counter(candidates), args.dropdown_threshold, row.name, data['name'])
   if len(candidates) == 1:
-    if row.name in autoresolved and data['name'] in autoresolved[row.name]: flow_report('Autoresolved', row.name, row['data.aligned_text'])
-    else: flow_report('Unanimous', row.name, row['data.aligned_text'])
+    if row.name in autoresolved: flow_report('number_resolver Autoresolved', row.name, row['data.aligned_text'])
+    else: flow_report('number_resolver Unanimous', row.name, row['data.aligned_text'])
     return next(iter(candidates)) #First key, efficiently (see https://www.geeksforgeeks.org/python-get-the-first-key-in-dictionary/)
   else:
-    flow_report('Unresolvable', row.name, row['data.aligned_text'])
-    bad[row.name] += 1
-    return pretty_candidates(row['data.aligned_text'], row['data.consensus_text'])
+    flow_report('number_resolver Unresolvable', row.name, row['data.aligned_text'])
+    bad.add(row.name)
+    return pretty_candidates(row[DECODED], row['data.consensus_text'])
 
 #Process data for output
 #Strings use Levenshtein distance approach, IIRC
 #Take a different approach for non-string data
 def text_resolver(row, **kwargs):
-  global args, bad, autoresolved #Just being explicit that these are global
   data = kwargs['data']
   datacol = kwargs['datacol']
 
@@ -400,205 +692,496 @@ def text_resolver(row, **kwargs):
     if not pd.isnull(row['data.consensus_score']): raise Exception('Broken assumption')
     return ''
 
-  if data['nptype'] == str: return string_resolver(row, data, datacol)
-  elif data['nptype'] == pd.Int64Dtype: return number_resolver(row, data, datacol)
+  if data['nptype'] == pd.Int64Dtype: return number_resolver(row, data, datacol)
   elif data['nptype'] == datetime.date: return date_resolver(row, data)
   else: raise Exception()
 
-def main():
-  global args, bad, autoresolved #Be explicit that these are global
+def reducer_file(wid, data):
+  return f'{args.dir}/{data["ztype"]["type"]}_reducer_{wid}.csv'
+
+def task_labels_file(wid, data):
+  if type(data['version']) is list: #Assume that labels are the same in all versions, just use the first file. extract.py checks for this.
+    return f'{args.dir}/Task_labels_workflow_{wid}_V{data["version"][0]}.yaml'
+  else:
+    return f'{args.dir}/Task_labels_workflow_{wid}_V{data["version"]}.yaml'
+
+#Read in the reduced data for a single workflow and count its views, dropping rows that do not have enough views.
+#Returns a tuple of:
+#  * The reduced data
+#  * The decoded reducer literals (see decode_literals)
+#  * For dropdowns, the votes in long form (see dropdown_votes). None for text.
+#  * The views for each row, as a Series
+#  * Counts of repeat classifications by the same logged-in user (None if there are none)
+#  * The fields removed for having too few views (None if running with --unfinished)
+def load_workflow(wid, data, definitions):
+  TEXT_T = definitions['TEXT_T']
+  DROP_T = definitions['DROP_T']
+  nonunique = None
+  removed = None
+  votes = None
+
+  datacol = data['ztype']['name']
+  conflict_keys = {}
+  reduced_file = reducer_file(wid, data)
+  if data['ztype'] == TEXT_T: #data that we use to make decisions about how well reconciliation worked
+    conflict_keys = {
+      'data.aligned_text': str,
+      'data.number_views': float, #TODO: I cannot see how this would be other than an int, but Pandas insists that it must be treated as float -- maybe due to NaNs??
+      'data.consensus_score': float
+    }
+  try:
+    df = pd.read_csv(reduced_file,
+                     index_col = KEYS,
+                     usecols   = KEYS + [datacol] + list(conflict_keys.keys()),
+                     converters = KEYS_CONVERTERS,
+                     dtype = {**KEYS_DTYPES, datacol: str, **conflict_keys},
+                     skip_blank_lines = False)
+  except:
+    print(f'Error while reading {reduced_file}')
+    raise
+  assert df.index.unique
+  decoded = decode_literals(reduced_file, df, ['data.aligned_text' if data['ztype'] == TEXT_T else datacol])
+  track(f'  * {data["name"]}: reduced data read', rows = len(df.index))
+
+  #count views
+  if data['ztype'] == TEXT_T:
+    #For Zooniverse-text fields, we must count rows in the extractor to get an accurate number of views.
+    #This is because the reducer discards empty entries, but we consider these to be legitimate views.
+    current_views, nonunique_counts = count_text_views(wid)
+    if nonunique_counts is not None: #We also count repeat classifications by the same (logged-in) user
+      nonunique = nonunique_counts.rename(data['name'])
+  elif data['ztype'] == DROP_T:
+    #Blank entries for dropdowns appear to come out as type 'None' with n votes --
+    #so they are counted and we do not need to do the work in count_text_views to count everything
+    #TODO: Add a unique users check to this one, similar to the one in count_text_views
+    votes = dropdown_votes(decoded[datacol])
+    current_views = votes.groupby(level = KEYS, sort = False)['votes'].sum().reindex(df.index, fill_value = 0)
+  current_views = current_views.rename(data['name'])
+  dump_interim(current_views, f'current_views_{data["name"]}')
+  track(f'  * {data["name"]}: views counted', rows = len(current_views.index))
+  if not current_views.index.equals(df.index): #redundant for dropdowns, where it is derived from df, but text strictly comes from a different source.
+                                               #we have already asserted that df.index is unique, so if they are equal then current_views.index is also necessarily unique
+                                               #if we make it out of the body of this if statement, the indices will now be equal (and therefore unique)
+    c_set = set(current_views.index)
+    i_set = set(df.index)
+    if c_set - i_set != set(): #I do not know what would cause such a case, consider it if it comes up
+      raise Exception('current_views contains entries that are missing in full dataframe')
+    elif i_set - c_set != set(): #There are entries in the full df that are missing from current_views. This can happen if rows have never been classified
+                                 #So far, it looks like this can happen if there are "extra" rows available in phase2 that have been left blank because they are not actually on the page
+                                 #FIXME: Should I be catching this at cleaning time? It looks like the users may be supposed to enter "No rows" in this case.
+                                 #       If so, it may be sufficient to reduce all of this to a test for index inequality, as in the enclosing if statement.
+                                 #       Note that this requires fixing up the reductions file, as the whole problem here is that these rows have not been classified.
+                                 #       At present, cleaning is a pre-reduction step, so would need to think about the wisdom of that. For now, I think catch it here
+                                 #       and hope that reconciliation just sorts this out (which it should, if enough people are entering "No rows").
+      spares = list(i_set - c_set)
+      spares_df = df.loc[spares]
+      df = df.drop(spares)
+      if not current_views.index.equals(df.index): raise Exception() #The drop above should have fixed this
+      if not spares_df.isna().all(axis = None): #If any of these entries are non-null then I do not know what is happening, figure it out if it ever comes up
+        raise Exception('df has non-null entries that are missing from current_views')
+      if args.verbose == 0: #This feels like a bug condition, so always warn about it. When I first wrote this comment I think that I thought that this might relate to unfinished data entries which I hoped would reconcile into not being problems. Now I wonder if this might also/instead have to do with cases where there are live workflow versions with different numbers of rows -- in which case I would expect to see concentrations of this warning around workflows with extract_diff_ok in workflow.yaml, probably in proportion to the number of classifications for the "less rows" version -- a snapshot of which can be seen in config_file_comparisons_phase2.ods.
+        print(f'  Warning: auto-removed {len(spares)} unclassified tasks in {data["name"]}', file = sys.stderr) #I believe that these work out as cases where "No row" was not entered. See the rest of this code block.
+      if args.verbose >= 1:
+        print(f'  Removed {len(spares)} null tasks from {data["name"]} due to absent classifications')
+      if args.verbose >= 3:
+        print(f'  The following task numbers in {data["name"]} are un-entered:')
+        spare_ids = sorted({x[0] for x in spares})
+        subjects_spares_df = get_subjects_df(f'{args.dir}/subjects_metadata.csv').loc[spare_ids][['volume','page','location']] #FIXME: Reading the subjects file from disk every time we get here -- if we keep this code, then we could read the subjects file once at the beginning of this script. It is treated as read-only, so it can safely be global.
+        for subject_id in spare_ids:
+          vol, page, url = subjects_spares_df.loc[subject_id]
+          tasks = spares_df.loc[subject_id].index
+          if len(tasks) == 1: #Single-line output where possible, can halve the vertical space used
+            print(f'  In vol. {vol:2}, p. {page:3}: T{tasks[0]}  (subject id: {subject_id} [{url}])')
+          else:
+            print(f'  In vol. {vol:2}, p. {page:3} (subject id: {subject_id} [{url}])')
+            print(f'    {", ".join(["T" + str(x) for x in sorted(tasks)])}')
+    else: #I guess they could be in different orders?
+      raise Exception('Indices are non-equal but contain the same entries')
+
+  if not args.unfinished:
+    #Drop all classifications that are based on an insufficient number of views
+    unfinished_idx = current_views[current_views < RETIREMENT_COUNT].index
+    removed = df.loc[unfinished_idx][datacol].rename(data['name']) #We never write to this, so don't really mind if this is a reference or a copy (though copy would be less fragile!)
+    df = df.drop(unfinished_idx)
+    current_views = current_views.drop(unfinished_idx)
+    dump_interim(removed, f'removed_{data["name"]}')
+    if args.verbose >= 1 and len(removed) != 0: print(f'  Removed {len(removed)} classifications from {data["name"]} due to unreached retirement count')
+    if args.verbose >= 3: print(removed)
+
+  #User can shrink the number of rows to be read, for faster runs.
+  #This will be used for run-to-run output comparison, so must be repeatable.
+  #Taking every nth row might give a better overall sample of the data than just taking head or tail.
+  #But if people tend to classify the same records at around the same time, every nth row might result in few complete classifications.
+  #Note that this does not affect the views count for TEXT_T, which is always based on the entire text_exporter file. This means the results are spurious in that rows are admitted even if they no longer have enough views to be considered complete, but the point of this feature is just to be able to compare for unexpected output changes.
+  if args.row_factor:
+    assert(len(df.index.symmetric_difference(current_views.index)) == 0)
+    df = df.iloc[::int(100 / args.row_factor)]
+    current_views = current_views.loc[df.index]
+
+  #Report on rows with different counts
+  if args.verbose >= 1:
+    overcount = df.loc[current_views[current_views > RETIREMENT_COUNT].index]
+    print(f'  Completed rows: {len(df.index)} (of which {len(overcount.index)} overcounted)')
+    if args.verbose >= 3 and not overcount.empty:
+      if args.dump_interims: dump_interim(overcount, f'overcount_{data["name"]}')
+      else: print(overcount.to_string())
+    if args.unfinished:
+      undercount = df.loc[current_views[current_views < RETIREMENT_COUNT].index]
+      print(f'  Undercounted rows: {len(undercount.index)}')
+      if args.verbose >= 3 and not undercount.empty:
+        if args.dump_interims: dump_interim(undercount, f'undercount_{data["name"]}')
+        else: print(undercount.to_string())
+
+  track(f'  * {data["name"]}: unfinished rows dropped', rows = len(df.index))
+  return (df, decoded, votes, current_views, nonunique, removed)
+
+#Resolve the conflicts in a workflow's data, as returned by load_workflow, at the current thresholds.
+#Returns a tuple of:
+#  * The resolved data, as a single-column DataFrame named for the workflow
+#  * Boolean Series flagging the rows where this workflow's field is unresolved, and where it was autoresolved
+#While resolving, the resolvers record rows in the globals 'bad' and 'autoresolved'. These only ever hold the current workflow.
+def resolve_conflicts(wid, data, definitions, df, decoded, votes):
+  TEXT_T = definitions['TEXT_T']
+  DROP_T = definitions['DROP_T']
+  datacol = data['ztype']['name']
+  bad.clear()
+  autoresolved.clear()
+
+  #Handle conflicts
+  if(data['ztype'] == TEXT_T):
+    df[DECODED] = decoded['data.aligned_text'] #Aligns on index, so any rows dropped above stay dropped
+    if data['nptype'] == str: df[datacol] = string_resolver(df, data, datacol) #Strings are resolved column-wise
+    else: df[datacol] = df.apply(text_resolver, axis = 'columns', data = data, datacol = datacol)
+  elif(data['ztype'] == DROP_T):
+    #Resolve and convert to labels in one go
+    df[datacol] = decoded[datacol].str[0] #The dict of votes, for reporting
+    df[datacol] = drop_resolver(df, data, datacol, votes, compile_task_labels(task_labels_file(wid, data)))
+  else: raise Exception()
+
+  df = df[datacol].rename(data['name']).to_frame() #Keep just the data column, renaming it to something meaningful and keeping it a DF rather than a Series
+
+  unresolved = pd.Series(df.index.isin(list(bad)), index = df.index, name = data['name'])
+  autos = pd.Series(df.index.isin(list(autoresolved)), index = df.index, name = data['name'])
+  return (df, unresolved, autos)
+
+#The --state store holds, for each workflow:
+#  * In 'workflows', a fingerprint of everything other than the cell's own data that affects how its cells resolve
+#  * In 'cells', one line per (subject_id, task) with a fingerprint of the cell's reduced data and view count,
+#    and the resolution of the cell: its (pickled) value and whether it was unresolved or autoresolved.
+def open_state():
+  connection = sqlite3.connect(args.state, timeout = 600) #--jobs workers take turns to write
+  connection.executescript('''
+    CREATE TABLE IF NOT EXISTS workflows(workflow TEXT PRIMARY KEY, context TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS cells(workflow TEXT NOT NULL, subject_id INTEGER NOT NULL, task INTEGER NOT NULL,
+                                     fingerprint INTEGER NOT NULL, value BLOB, unresolved INTEGER NOT NULL, autoresolved INTEGER NOT NULL,
+                                     PRIMARY KEY(workflow, subject_id, task));
+  ''')
+  return connection
+
+#Resolve a workflow's data, as returned by load_workflow, reusing the resolutions of unchanged cells from the --state store.
+#Returns the same as resolve_conflicts, and updates the store.
+#Reused cells are not reported by --flow_report or --flow_counts.
+def resolve_incrementally(wid, data, definitions, df, decoded, votes, current_views):
+  context = {'version': STATE_VERSION, 'data': repr(data), 'text_threshold': args.text_threshold,
+             'dropdown_threshold': args.dropdown_threshold, 'uncertainty': args.uncertainty}
+  if data['ztype'] == definitions['DROP_T']: context['labels'] = file_hash(task_labels_file(wid, data))
+  context = json.dumps(context, sort_keys = True)
+
+  #Fingerprint each cell on its reduced data and its view count
+  fingerprints = pd.util.hash_pandas_object(df.assign(views = current_views).reset_index(), index = False)
+  fingerprints = pd.Series(fingerprints.values.astype('int64'), index = df.index) #SQLite integers are signed
+
+  connection = open_state()
+  with connection: #Commits on success
+    stored_context = connection.execute('SELECT context FROM workflows WHERE workflow = ?', (data['name'],)).fetchone()
+    if stored_context is None or stored_context[0] != context:
+      if stored_context is not None and args.verbose >= 1: print(f'  Settings have changed since {data["name"]} was stored, resolving it from scratch')
+      connection.execute('DELETE FROM cells WHERE workflow = ?', (data['name'],))
+      connection.execute('INSERT OR REPLACE INTO workflows VALUES (?, ?)', (data['name'], context))
+    stored = pd.read_sql_query('SELECT subject_id, task, fingerprint, value, unresolved, autoresolved FROM cells WHERE workflow = ?',
+                               connection, params = (data['name'],), index_col = KEYS)
+
+    reusable = stored['fingerprint'].reindex(df.index).eq(fingerprints)
+    gone = stored.index.difference(df.index)
+    stored = stored.loc[df.index[reusable]]
+    changed = df[~reusable].copy()
+    if args.verbose >= 1: print(f'  Reusing {reusable.sum()} stored resolutions in {data["name"]}, resolving {len(changed.index)}')
+    if len(changed.index): resolved, unresolved, autos = resolve_conflicts(wid, data, definitions, changed, decoded, votes)
+    else:
+      resolved = pd.DataFrame({data['name']: pd.Series(dtype = object)}, index = changed.index)
+      unresolved = autos = pd.Series(dtype = bool, index = changed.index)
+
+    connection.executemany('DELETE FROM cells WHERE workflow = ? AND subject_id = ? AND task = ?',
+                           [(data['name'], int(s), int(t)) for s, t in gone])
+    connection.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(data['name'], int(s), int(t), int(f), pickle.dumps(v, protocol = pickle.HIGHEST_PROTOCOL), int(u), int(a))
+                            for (s, t), f, v, u, a in zip(resolved.index, fingerprints[resolved.index], resolved[data['name']], unresolved, autos)])
+  connection.close()
+
+  #Merge, keeping to the order of df. Build the column from a list, as DataFrame.apply would, so that dtypes come out the same.
+  values = pd.concat([stored['value'].map(pickle.loads), resolved[data['name']]]).reindex(df.index)
+  df = pd.Series(values.tolist(), index = df.index, name = data['name']).to_frame()
+  unresolved = pd.concat([stored['unresolved'].astype(bool), unresolved]).reindex(df.index).rename(data['name'])
+  autos = pd.concat([stored['autoresolved'].astype(bool), autos]).reindex(df.index).rename(data['name'])
+  return (df, unresolved, autos)
+
+#Read in the reduced data for a single workflow, count its views and resolve its conflicts.
+#Returns a tuple of:
+#  * The resolved data, as a single-column DataFrame named for the workflow
+#  * The views for each row, as a Series
+#  * Counts of repeat classifications by the same logged-in user (None if there are none)
+#  * The fields removed for having too few views (None if running with --unfinished)
+#  * Boolean Series flagging the rows where this workflow's field is unresolved, and where it was autoresolved
+#  * The flow counts and stage profiles for this workflow, so that a --jobs worker can hand them back
+def resolve_workflow(wid, data, definitions):
+  flow_report.workflow = data['name']
+  if args.jobs > 1: #Workers' output would interleave, so collect this workflow's flow report for main to print in order
+    flow_report.messages = []
+    flow_report.reported = set()
+  track_start(data['name'])
+  df, decoded, votes, current_views, nonunique, removed = load_workflow(wid, data, definitions)
+  if args.state: df, unresolved, autos = resolve_incrementally(wid, data, definitions, df, decoded, votes, current_views)
+  else:          df, unresolved, autos = resolve_conflicts(wid, data, definitions, df, decoded, votes)
+
+  flows = {k: (v, flow_samples[k]) for k, v in flow_counts.items() if k[1] == data['name']}
+  track(f'* {reducer_file(wid, data)} ({data["name"]}) done', rows = len(df.index), regardless = True)
+  stages = [x for x in track.stages if x['workflow'] == data['name']]
+  track_start() #Back to main's stages
+  sys.stdout.flush() #A --jobs worker may be terminated without flushing
+  return (df, current_views, nonunique, removed, unresolved, autos, flows, stages, flow_report.messages)
+
+#Patterns in reconciled values that indicate transcription uncertainty, by name.
+#Note that it may be that only part of the uncertainty identifier has survived autoresolution.
+#For this reason, we cannot use the exact same patterns as in the pre-resultion function 'uncertainty'.
+TRANSCRIPTIONISMS = {
+  'bracket':  r'[\[\]\{\}]', #Any sort of bracket (apart from round, which come up too much in correct contexts)
+  'dots':     r'\.\.', #More than one '.' in succession
+  'question': r'\?', #A question mark
+  #r'[^\d]*\.[^ \d$]', #A single dot that (a) does not appear to be part of a number and (b) does not appear to be a full stop. Did away with this one as it matches dots in abbreviations and initials -- far too noisy.
+}
+#Misplaced zeros. Only a transcriptionism outside of number fields.
+ZEROS_TRANSCRIPTIONISM = {'zeros': r'^0+$'}
+
+#Scan the given columns of df for transcriptionisms. All of the patterns for a column are compiled into a single
+#alternation of named groups, and each distinct string in the column is searched once.
+#Return a DataFrame of rows x columns, holding the name of the pattern that matched each cell (NaN if none did).
+#Where more than one pattern matches a cell, this is the one that matched earliest in the string.
+def find_transcriptionisms(df, columns, number_columns):
+  matches = pd.DataFrame(index = df.index)
+  for c in columns:
+    patterns = TRANSCRIPTIONISMS if c in number_columns else {**ZEROS_TRANSCRIPTIONISM, **TRANSCRIPTIONISMS}
+    regex = re.compile('|'.join([f'(?P<{k}>{v})' for k, v in patterns.items()]))
+    values = df[c][df[c].map(lambda x: isinstance(x, str))] #Anything else (blanks, resolved numbers) cannot hold a transcriptionism
+    hits = {}
+    for value in values.unique():
+      match = regex.search(value)
+      if match: hits[value] = match.lastgroup
+    matches[c] = values.map(hits).reindex(df.index)
+  return matches
+
+#Receive a boolean DataFrame of rows x fields
+#Return a Series listing the True fields in each row, separated by '; ' (so empty if there are none)
+def flagged_fields(flags):
+  return flags.dot(flags.columns + '; ').str[:-2]
+
+#The steps below turn the resolved workflows into the rows of joined.csv. main and threshold_sweep both use them,
+#so that the sweep counts exactly what a run at the same thresholds would write.
+
+def empty_cell(cell):
+  if isinstance(cell, str):
+    if cell.strip() == '': return True
+    try: cell = float(cell)
+    except ValueError: return False
+  if isinstance(cell, float): return cell == 0
+  if isinstance(cell, int): return cell == 0
+  return False
 
-  RETIREMENT_COUNT = 3 #I believe that this is the same for all workflows at all times. Can be parameterised in workflows.yaml if need be.
+#Return a mask of the rows of joined in which every cell is empty
+def blank_rows(joined):
+  return joined.fillna('').applymap(empty_cell).all(axis = 1)
+
+#Handle the 'port sailed out of' special case -- but only if the relevant volume exists
+#This should really be defined in the YAML file somehow, or otherwise made data-driven
+#Blanks any port given in volume 1 of joined (which must have its subjects identified), marking it as autoresolved in autos.
+#Returns the volume 1 subject ids and the rows whose port was blanked, as they were before (None if there is no volume 1).
+#With report = False, the flow report and verbose output are left out.
+def fix_volume_1_ports(joined, autos, report = True):
+  vol_1_subj_ids = list(set(joined[joined['volume'] == 1].index.get_level_values(0)))
+  if len(vol_1_subj_ids) == 0: return vol_1_subj_ids, None
+  bad_ports = joined.loc[vol_1_subj_ids]['port sailed out of'][joined.loc[vol_1_subj_ids]['port sailed out of'].notnull()].index
+  if report:
+    flow_report.workflow = 'port sailed out of'
+    if args.flow_report:
+      for bad_port in bad_ports: flow_report('main port sailed out of in volume 1', bad_port, joined.loc[bad_port])
+    else: flow_tally('main port sailed out of in volume 1', list(bad_ports))
+    if args.verbose >= 1 and len(bad_ports) != 0: print(f'  {len(bad_ports)} rows in volume 1 incorrectly had a port')
+  autos.loc[bad_ports, 'port sailed out of'] = True
+  removed = joined.loc[bad_ports,['original','volume','page','port sailed out of']]
+  joined.loc[bad_ports,['port sailed out of']] = ''
+  return vol_1_subj_ids, removed
+
+#Add the 'complete' column to joined_views: a row is complete if every workflow has had enough views
+#(bar 'port sailed out of' in volume 1, which has no such column)
+def mark_complete_views(joined_views, workflow_columns, vol_1_subj_ids):
+  joined_views['complete'] = joined_views[workflow_columns].ge(RETIREMENT_COUNT).all(axis = 1)
+  if len(vol_1_subj_ids) != 0:
+    joined_views.loc[vol_1_subj_ids,['complete']] = joined_views.loc[vol_1_subj_ids][workflow_columns].drop('port sailed out of', axis = 1).ge(RETIREMENT_COUNT).all(axis = 1)
+
+#Return a boolean DataFrame of rows x workflow_columns, flagging the cells of joined that hold a transcriptionism
+#(all False with --no_transcriptionisms), and the matches themselves (None with --no_transcriptionisms)
+def transcriptionism_flags(joined, workflow, workflow_columns):
+  if args.no_transcriptionisms: return pd.DataFrame(False, index = joined.index, columns = workflow_columns), None
+  matches = find_transcriptionisms(joined, get_flows(workflow), get_number_flows(workflow))
+  return matches.notnull().reindex(columns = workflow_columns, fill_value = False), matches
+
+#Return a boolean Series flagging the rows of joined with a blank field (bar 'port sailed out of' in volume 1)
+def blank_fields(joined, workflow_columns, vol_1_subj_ids):
+  blanks = joined[workflow_columns].isnull().any(axis = 1)
+  if len(vol_1_subj_ids) != 0:
+    blanks.loc[vol_1_subj_ids] = joined.loc[vol_1_subj_ids][workflow_columns].drop('port sailed out of', axis = 1).isnull().values.any(axis = 1)
+  return blanks
+
+#Return a DataFrame summarising each page (subject) in joined_views, which must have its 'complete' column.
+#A page is complete if it has exactly the expected number of rows, and every one of them is complete
+def page_completeness(joined_views, rows_per_page):
+  pages = joined_views['complete'].groupby(level = 'subject_id').agg(rows_present = 'size', rows_complete = 'sum')
+  expected = pd.MultiIndex.from_product([pages.index, range(1, rows_per_page + 1)], names = KEYS)
+  missing = expected.difference(joined_views.index).to_frame(index = False).groupby('subject_id')['task']
+  pages['missing_tasks'] = missing.agg(lambda x: ' '.join(map(str, x))).reindex(pages.index, fill_value = '')
+  pages['complete'] = pages['rows_present'].eq(rows_per_page) & pages['rows_complete'].eq(pages['rows_present'])
+  return pages
+
+#Return the number of unresolved fields in each row, as given in the Problems column.
+#A transcriptionism is not attributed to a field, so only counts if the row has no other unresolved fields
+def unresolved_counts(unresolved, transcriptionisms):
+  counts = unresolved.sum(axis = 1)
+  return counts.mask(counts.eq(0) & transcriptionisms.any(axis = 1), 1)
+
+#Resolve every workflow at each combination of the --threshold_sweep and --dropdown_sweep thresholds, reading the data only once.
+#The text threshold only matters for string fields, and the dropdown threshold only for the others,
+#so each workflow is only resolved once for each threshold that matters to it.
+#Each combination then goes through the same steps as in main (blank rows dropped, volume 1 ports fixed up,
+#transcriptionisms flagged and, without --unfinished, incomplete pages removed), so that the counts are those
+#of the joined.csv that a run at those thresholds would write: rows, rows with unresolved fields, rows with
+#only blanks, complete rows (neither), unresolved fields (as summed from Problems) and autoresolved fields.
+#Returns a DataFrame with a line for each combination of thresholds.
+def threshold_sweep(workflow):
+  definitions = workflow['definitions']
+  workflows = workflow[args.workflow_set]['workflows']
+  workflow_columns = [x['name'] for x in workflows.values()]
+  text_thresholds = args.threshold_sweep
+  dropdown_thresholds = args.dropdown_sweep or [args.dropdown_threshold]
+  text_workflows = set()
+  resolved = {} #(workflow name, threshold) -> (df, unresolved, autos)
+  views = []
+  for wid, data in workflows.items():
+    flow_report.workflow = data['name']
+    df, decoded, votes, current_views, _, _ = load_workflow(wid, data, definitions)
+    views.append(current_views)
+    if data['ztype'] == definitions['TEXT_T'] and data['nptype'] == str:
+      text_workflows.add(data['name'])
+      for threshold in text_thresholds:
+        args.text_threshold = threshold
+        resolved[(data['name'], threshold)] = resolve_conflicts(wid, data, definitions, df.copy(), decoded, votes)
+    else:
+      for threshold in dropdown_thresholds:
+        args.dropdown_threshold = threshold
+        resolved[(data['name'], threshold)] = resolve_conflicts(wid, data, definitions, df.copy(), decoded, votes)
+    track(f'* {reducer_file(wid, data)} ({data["name"]}) swept', regardless = True)
+
+  all_views = views[0].to_frame().join(views[1:], how = 'outer')
+  subjects = get_subjects_df(f'{args.dir}/subjects_metadata.csv')[['location', 'volume', 'page']]
+  table = []
+  for text_threshold in text_thresholds:
+    for dropdown_threshold in dropdown_thresholds:
+      chosen = [resolved[(data['name'], text_threshold if data['name'] in text_workflows else dropdown_threshold)] for data in workflows.values()]
+      joined = chosen[0][0].join([x[0] for x in chosen[1:]], how = 'outer')
+      unresolved = pd.concat([x[1] for x in chosen], axis = 1).reindex(joined.index).fillna(False).astype(bool)
+      autos = pd.concat([x[2] for x in chosen], axis = 1).reindex(joined.index).fillna(False).astype(bool)
+
+      empty_row_mask = blank_rows(joined)
+      joined = joined.drop(joined[empty_row_mask].index)
+      joined_views = all_views.drop(all_views[empty_row_mask].index)
+      joined = subjects.join(joined).rename(columns = {'location': 'original'})
+      vol_1_subj_ids, _ = fix_volume_1_ports(joined, autos, report = False)
+      mark_complete_views(joined_views, workflow_columns, vol_1_subj_ids)
+      transcriptionisms, _ = transcriptionism_flags(joined, workflow, workflow_columns)
+      blanks = blank_fields(joined, workflow_columns, vol_1_subj_ids)
+      if not args.unfinished:
+        pages = page_completeness(joined_views, workflow[args.workflow_set].get('rows_per_page', 25))
+        joined = joined[~joined.index.get_level_values('subject_id').isin(pages.index[~pages['complete']])]
+
+      counts = unresolved_counts(unresolved.reindex(joined.index), transcriptionisms.reindex(joined.index))
+      blanks = blanks.reindex(joined.index)
+      rows = len(joined.index)
+      cells = rows * len(workflow_columns)
+      table.append({
+        'text_threshold': text_threshold,
+        'dropdown_threshold': dropdown_threshold,
+        'rows': rows,
+        'unresolved_rows': counts.gt(0).sum(),
+        'blank_only_rows': (blanks & counts.eq(0)).sum(),
+        'complete_rows': (~blanks & counts.eq(0)).sum(),
+        'unresolved_cells': counts.sum(),
+        'autoresolved_cells': autos.reindex(joined.index)[workflow_columns].values.sum(),
+        'unresolved_rows_percent': round(100 * counts.gt(0).sum() / rows, 1) if rows else 0.0,
+        'unresolved_cells_percent': round(100 * counts.sum() / cells, 1) if cells else 0.0,
+      })
+  return pd.DataFrame(table)
+
+def main():
+  global args #Be explicit that this is global
 
   try: os.mkdir(args.output_dir)
   except FileExistsError:
     print(f"Output directory '{args.output_dir}' already exists.\nPlease delete it before running this script, or use --output_dir to output to a different directory.", file = sys.stderr)
     sys.exit(1)
   if args.dump_interims: os.mkdir(f'{args.output_dir}/interims')
+  if args.timing and args.cprofile: os.mkdir(f'{args.output_dir}/cprofile')
 
   with open(args.workflow_defs) as f:
     workflow = yaml.load(f, Loader = yaml.Loader)
 
   #Read in the reduced data.
   columns = []
-  TEXT_T = workflow['definitions']['TEXT_T']
-  DROP_T = workflow['definitions']['DROP_T']
 
   #Declare array to store record of what we have processed, and another to store records with repeat views by a given user
-  workflow_columns = []
   views = []
   nonunique_views = []
   removed = []
+  unresolved = []
+  autos = []
 
   track('Processing workflows')
-  for wid, data in workflow[args.workflow_set]['workflows'].items():
-    workflow_columns.append(data['name'])
-    datacol = data['ztype']['name']
-    conflict_keys = {}
-    reduced_file = f'{args.dir}/{data["ztype"]["type"]}_reducer_{wid}.csv'
-    if data['ztype'] == TEXT_T: #data that we use to make decisions about how well reconciliation worked
-      conflict_keys = {
-        'data.aligned_text': str,
-        'data.number_views': float, #TODO: I cannot see how this would be other than an int, but Pandas insists that it must be treated as float -- maybe due to NaNs??
-        'data.consensus_score': float
-      }
-    try:
-      df = pd.read_csv(reduced_file,
-                       index_col = KEYS,
-                       usecols   = KEYS + [datacol] + list(conflict_keys.keys()),
-                       converters = KEYS_CONVERTERS,
-                       dtype = {**KEYS_DTYPES, datacol: str, **conflict_keys},
-                       skip_blank_lines = False)
-    except:
-      print(f'Error while reading {reduced_file}')
-      raise
-    assert df.index.unique
-
-    #count views
-    if data['ztype'] == TEXT_T:
-      #For Zooniverse-text fields, we must count rows in the extractor to get an accurate number of views.
-      #This is because the reducer discards empty entries, but we consider these to be legitimate views.
-      current_views, nonunique_counts = count_text_views(wid)
-      if nonunique_counts is not None: #We also count repeat classifications by the same (logged-in) user
-        nonunique_views.append(nonunique_counts.rename(data['name']))
-    elif data['ztype'] == DROP_T:
-      #Blank entries for dropdowns appear to come out as type 'None' with n votes --
-      #so they are counted and we do not need to do the work in count_text_views to count everything
-      #TODO: Add a unique users check to this one, similar to the one in count_text_views
-      def votecounter(votes):
-        selections = ast.literal_eval(votes)
-        if len(selections) != 1: raise Exception()
-        return(sum(selections[0].values()))
-      current_views = df[datacol].apply(votecounter)
-    current_views = current_views.rename(data['name'])
-    dump_interim(current_views, f'current_views_{data["name"]}')
-    if not current_views.index.equals(df.index): #redundant for dropdowns, where it is derived from df, but text strictly comes from a different source.
-                                                 #we have already asserted that df.index is unique, so if they are equal then current_views.index is also necessarily unique
-                                                 #if we make it out of the body of this if statement, the indices will now be equal (and therefore unique)
-      c_set = set(current_views.index)
-      i_set = set(df.index)
-      if c_set - i_set != set(): #I do not know what would cause such a case, consider it if it comes up
-        raise Exception('current_views contains entries that are missing in full dataframe')
-      elif i_set - c_set != set(): #There are entries in the full df that are missing from current_views. This can happen if rows have never been classified
-                                   #So far, it looks like this can happen if there are "extra" rows available in phase2 that have been left blank because they are not actually on the page
-                                   #FIXME: Should I be catching this at cleaning time? It looks like the users may be supposed to enter "No rows" in this case.
-                                   #       If so, it may be sufficient to reduce all of this to a test for index inequality, as in the enclosing if statement.
-                                   #       Note that this requires fixing up the reductions file, as the whole problem here is that these rows have not been classified.
-                                   #       At present, cleaning is a pre-reduction step, so would need to think about the wisdom of that. For now, I think catch it here
-                                   #       and hope that reconciliation just sorts this out (which it should, if enough people are entering "No rows").
-        spares = list(i_set - c_set)
-        spares_df = df.loc[spares]
-        df = df.drop(spares)
-        if not current_views.index.equals(df.index): raise Exception() #The drop above should have fixed this
-        if not spares_df.isna().all(axis = None): #If any of these entries are non-null then I do not know what is happening, figure it out if it ever comes up
-          raise Exception('df has non-null entries that are missing from current_views')
-        if args.verbose == 0: #This feels like a bug condition, so always warn about it. When I first wrote this comment I think that I thought that this might relate to unfinished data entries which I hoped would reconcile into not being problems. Now I wonder if this might also/instead have to do with cases where there are live workflow versions with different numbers of rows -- in which case I would expect to see concentrations of this warning around workflows with extract_diff_ok in workflow.yaml, probably in proportion to the number of classifications for the "less rows" version -- a snapshot of which can be seen in config_file_comparisons_phase2.ods.
-          print(f'  Warning: auto-removed {len(spares)} unclassified tasks in {data["name"]}', file = sys.stderr) #I believe that these work out as cases where "No row" was not entered. See the rest of this code block.
-        if args.verbose >= 1:
-          print(f'  Removed {len(spares)} null tasks from {data["name"]} due to absent classifications')
-        if args.verbose >= 3:
-          print(f'  The following task numbers in {data["name"]} are un-entered:')
-          spare_ids = sorted({x[0] for x in spares})
-          subjects_spares_df = get_subjects_df(f'{args.dir}/subjects_metadata.csv').loc[spare_ids][['volume','page','location']] #FIXME: Reading the subjects file from disk every time we get here -- if we keep this code, then we could read the subjects file once at the beginning of this script. It is treated as read-only, so it can safely be global.
-          for subject_id in spare_ids:
-            vol, page, url = subjects_spares_df.loc[subject_id]
-            tasks = spares_df.loc[subject_id].index
-            if len(tasks) == 1: #Single-line output where possible, can halve the vertical space used
-              print(f'  In vol. {vol:2}, p. {page:3}: T{tasks[0]}  (subject id: {subject_id} [{url}])')
-            else:
-              print(f'  In vol. {vol:2}, p. {page:3} (subject id: {subject_id} [{url}])')
-              print(f'    {", ".join(["T" + str(x) for x in sorted(tasks)])}')
-      else: #I guess they could be in different orders?
-        raise Exception('Indices are non-equal but contain the same entries')
-
-    if not args.unfinished:
-      #Drop all classifications that are based on an insufficient number of views
-      unfinished_idx = current_views[current_views < RETIREMENT_COUNT].index
-      removed.append(df.loc[unfinished_idx][datacol].rename(data['name'])) #We never write to this, so don't really mind if this is a reference or a copy (though copy would be less fragile!)
-      df = df.drop(unfinished_idx)
-      current_views = current_views.drop(unfinished_idx)
-      dump_interim(removed[-1], f'removed_{data["name"]}')
-      if args.verbose >= 1 and len(removed[-1]) != 0: print(f'  Removed {len(removed[-1])} classifications from {data["name"]} due to unreached retirement count')
-      if args.verbose >= 3: print(removed[-1])
-
-    #User can shrink the number of rows to be read, for faster runs.
-    #This will be used for run-to-run output comparison, so must be repeatable.
-    #Taking every nth row might give a better overall sample of the data than just taking head or tail.
-    #But if people tend to classify the same records at around the same time, every nth row might result in few complete classifications.
-    #Note that this does not affect the views count for TEXT_T, which is always based on the entire text_exporter file. This means the results are spurious in that rows are admitted even if they no longer have enough views to be considered complete, but the point of this feature is just to be able to compare for unexpected output changes.
-    if args.row_factor:
-      assert(len(df.index.symmetric_difference(current_views.index)) == 0)
-      df = df.iloc[::int(100 / args.row_factor)]
-      current_views = current_views.loc[df.index]
-
-    #Report on rows with different counts
-    if args.verbose >= 1:
-      overcount = df.loc[current_views[current_views > RETIREMENT_COUNT].index]
-      print(f'  Completed rows: {len(df.index)} (of which {len(overcount.index)} overcounted)')
-      if args.verbose >= 3 and not overcount.empty:
-        if args.dump_interims: dump_interim(overcount, f'overcount_{data["name"]}')
-        else: print(overcount.to_string())
-      if args.unfinished:
-        undercount = df.loc[current_views[current_views < RETIREMENT_COUNT].index]
-        print(f'  Undercounted rows: {len(undercount.index)}')
-        if args.verbose >= 3 and not undercount.empty:
-          if args.dump_interims: dump_interim(undercount, f'undercount_{data["name"]}')
-          else: print(undercount.to_string())
-
-    #Handle conflicts
-    if(data['ztype'] == TEXT_T):
-      df[datacol] = df.apply(text_resolver, axis = 'columns', data = data, datacol = datacol)
-    elif(data['ztype'] == DROP_T):
-      #Process classifications for output
-      def drop_resolver(row):
-        result = category_resolver(row[datacol], args.dropdown_threshold, row.name, data['name'])
-        if len(result) == 1:
-          if row.name in autoresolved and data['name'] in autoresolved[row.name]:
-            flow_report('Autoresolved', row.name, row['data.value'])
-          else: flow_report('Unanimous', row.name, row['data.value'])
-        else:
-          flow_report('Unresolvable', row.name, row['data.value'])
-          bad[row.name] += 1
-        return str([result])
-      #Dropdowns contain a single-element array, which contains a dictionary.
-      #Start by resolving that down to just a dictonary, vector-style
-      df[datacol] = df[datacol].apply(ast.literal_eval)
-      if not df[datacol].str.len().eq(1).all(): raise Exception()
-      df[datacol] = df[datacol].apply(lambda x: x[0])
-      #Then do the rest of the work
-      df[datacol] = df.apply(drop_resolver, axis = 'columns')
-    else: raise Exception()
-
-    df = df[datacol].rename(data['name']).to_frame() #Keep just the data column, renaming it to something meaningful and keeping it a DF rather than a Series
-
-    #Convert dropdowns to their values
-    if(data['ztype'] == DROP_T):
-      if type(data['version']) is list: #Assume that labels are the same in all versions, just use the first file. extract.py checks for this.
-        labelfile = f'{args.dir}/Task_labels_workflow_{wid}_V{data["version"][0]}.yaml'
-      else:                             labelfile = f'{args.dir}/Task_labels_workflow_{wid}_V{data["version"]}.yaml'
-      with open(labelfile) as f:
-        labels = yaml.full_load(f)
-      def decode_dropdown(row):
-          selections = ast.literal_eval(row[data['name']])
-          if len(selections) != 1: raise Exception()
-          selections = selections[0]
-          result = {}
-          for selection, votes in selections.items():
-            if selection == 'None': result[None] = votes
-            else:
-              label_list = list(labels[f'T{row.name[1]}.selects.0.options.*.{selection}.label'].values())
-              if len(label_list) != 1: raise Exception('\n'.join(['Assumption that label_list always contains 1 element is broken'] + label_list))
-              label = label_list[0]
-              label = label[label.find('=') + 1:].strip()
-              result[label] = votes
-          if len(result) == 1:
-            return list(result.keys())[0]
-          else: return pretty_candidates(result)
-      df[data['name']] = df.apply(decode_dropdown, axis = 'columns')
-
+  workflows = workflow[args.workflow_set]['workflows']
+  workflow_columns = [x['name'] for x in workflows.values()]
+  if args.threshold_sweep:
+    sweep = threshold_sweep(workflow)
+    sweep.to_csv(f'{args.output_dir}/threshold_sweep.csv', index = False)
+    print(sweep.to_string(index = False))
+    track('* All done')
+    return
+  if args.jobs > 1:
+    #Workflows are independent until they are joined, so resolve them in parallel.
+    #Fork explicitly: this script parses its arguments and runs main() at import, so cannot be re-imported by a spawned worker.
+    sys.stdout.flush() #Otherwise the workers inherit, and later repeat, anything still buffered
+    with multiprocessing.get_context('fork').Pool(args.jobs) as pool:
+      results = pool.starmap(resolve_workflow, [(wid, data, workflow['definitions']) for wid, data in workflows.items()])
+  else:
+    results = [resolve_workflow(wid, data, workflow['definitions']) for wid, data in workflows.items()]
+  for df, current_views, nonunique, removal, unresolved_flags, autoresolved_flags, flows, stages, flow_messages in results:
+    if args.jobs > 1: #In a serial run, these are already here
+      track.stages.extend(stages)
+      print_flow_messages(flow_messages)
+    for k, (count, samples) in flows.items(): #Assign rather than add: in a serial run, these are already here
+      flow_counts[k] = count
+      flow_samples[k] = samples
     columns.append(df)
     views.append(current_views)
-    track(f'* {reduced_file} ({data["name"]}) done', regardless = True)
+    if nonunique is not None: nonunique_views.append(nonunique)
+    if removal is not None: removed.append(removal)
+    unresolved.append(unresolved_flags)
+    autos.append(autoresolved_flags)
 
   track('Generating output', regardless = True)
   for c in columns: dump_interim(c, c.columns[0])
@@ -609,19 +1192,25 @@ def main():
   #Quick test shows that this assumption does hold for now.
   first = columns.pop(0)
   joined = first.join(columns, how='outer')
-  track('* Data joined')
+  track('* Data joined', rows = len(joined.index))
   dump_interim(joined, 'initial_joined')
 
+  #Unresolved and autoresolved fields, as boolean matrices of rows x workflows aligned to joined.
+  #Rows dropped from joined below need no special handling here: these are realigned to joined when the
+  #Problems and Autoresolved columns are built.
+  unresolved = pd.concat(unresolved, axis = 1).reindex(joined.index).fillna(False).astype(bool)
+  autos = pd.concat(autos, axis = 1).reindex(joined.index).fillna(False).astype(bool)
+
   for v in views: dump_interim(v, f'views_{v.name}')
   first = views.pop(0).to_frame()
   joined_views = first.join(views, how='outer')
-  track('* Views joined')
+  track('* Views joined', rows = len(joined.index))
   dump_interim(joined_views, 'initial_joined_views')
 
   if not args.unfinished:
     first = removed.pop(0).to_frame()
     first.join(removed, how='outer').to_csv(f'{args.output_dir}/incomplete_rows.csv')
-    track('* Removed fields logged')
+    track('* Removed fields logged', rows = len(joined.index))
 
   if not joined.index.equals(joined_views.index):
     print('Indexes of joined and joined_views are not equal. The indexes may have a different order. The following entries are in only one index:', file = sys.stderr)
@@ -640,93 +1229,45 @@ def main():
     first = nonunique_views.pop(0).to_frame()
     first.join(nonunique_views, how='outer').to_csv(f'{args.output_dir}/nonunique.csv')
 
-  def empty_cell(cell):
-    if isinstance(cell, str):
-      if cell.strip() == '': return True
-      try: cell = float(cell)
-      except ValueError: return False
-    if isinstance(cell, float): return cell == 0
-    if isinstance(cell, int): return cell == 0
-    return False
-  empty_row_mask = joined.fillna('').applymap(empty_cell).all(axis = 1)
-  for x in joined[empty_row_mask].index:
-    if x in bad: del bad[x]
-    if x in autoresolved: del autoresolved[x]
+  empty_row_mask = blank_rows(joined)
   joined = joined.drop(joined[empty_row_mask].index) #If that has resulted in entirely empty row, drop the whole row
   joined_views = joined_views.drop(joined_views[empty_row_mask].index) #Drop from the views as well -- we do not know which cells are unviewed and which are explicitly labelled blank, so we just need to keep reading them back in
-  track('* Entirely blank rows dropped')
+  track('* Entirely blank rows dropped', rows = len(joined.index))
 
   #Translate subjects ids into original filenames
   joined = get_subjects_df(f'{args.dir}/subjects_metadata.csv')[['location', 'volume', 'page']].join(joined).rename(columns = {'location': 'original'})
 
-  track('* Subjects identified')
+  track('* Subjects identified', rows = len(joined.index))
   dump_interim(joined, 'joined_subjects_identified')
 
-  #Handle the 'port sailed out of' special case -- but only if the relevant volume exists
-  #This should really be defined in the YAML file somehow, or otherwise made data-driven
-  vol_1_subj_ids = list(set(joined[joined['volume'] == 1].index.get_level_values(0)))
-  if len(vol_1_subj_ids) != 0:
-    bad_ports = joined.loc[vol_1_subj_ids]['port sailed out of'][joined.loc[vol_1_subj_ids]['port sailed out of'].notnull()].index
-    for bad_port in bad_ports:
-      if bad_port in autoresolved:
-        flow_report('port sailed out of in volume 1 (later)', bad_port, joined.loc[bad_port])
-        autoresolved[bad_port]['port sailed out of'] = None
-      else:
-        flow_report('port sailed out of in volume 1 (first)', bad_port, joined.loc[bad_port])
-        autoresolved[bad_port] = { 'port sailed out of': None }
-    if args.verbose >= 1 and len(bad_ports) != 0: print(f'  {len(bad_ports)} rows in volume 1 incorrectly had a port')
-    joined.loc[bad_ports,['original','volume','page','port sailed out of']].to_csv(f'{args.output_dir}/ports_removed.csv')
-    joined.loc[bad_ports,['port sailed out of']] = ''
-    track('* "Port sailed out of" fixed up')
+  vol_1_subj_ids, ports_removed = fix_volume_1_ports(joined, autos)
+  if ports_removed is not None:
+    ports_removed.to_csv(f'{args.output_dir}/ports_removed.csv')
+    track('* "Port sailed out of" fixed up', rows = len(joined.index))
 
-  joined_views['complete'] = joined_views[workflow_columns].ge(RETIREMENT_COUNT).all(axis = 1)
-  if len(vol_1_subj_ids) != 0:
-    joined_views.loc[vol_1_subj_ids,['complete']] = joined_views.loc[vol_1_subj_ids][workflow_columns].drop('port sailed out of', axis = 1).ge(RETIREMENT_COUNT).all(axis = 1)
-  track('* Complete views identified')
+  mark_complete_views(joined_views, workflow_columns, vol_1_subj_ids)
+  track('* Complete views identified', rows = len(joined.index))
   dump_interim(joined_views, 'joined_views_complete')
 
   #Search for transcription problems
   #We can find these by looking for square brackets and for misplaced zeros
   #But square brackets will show up in every cell that was already flagged as bad
-  #So we give up on counting the bad cells, and just make sure that we flag all
-  #rows that contain at least one of them
+  #So we do not add these cells to the count of unresolved fields, we just make sure that we flag all
+  #rows that contain at least one of them. The cells themselves are logged in transcriptionisms.csv.
   #Note that this must happen *after* bad port removal, or we will incorrectly identify values such as '00' in bad port as meaning that there is something bad in the row
-  if not args.no_transcriptionisms:
-    #This is carefully arranged to replicate the original behaviour
-    #TODO I can probably get a proper count now, or even identify the bad columns
-    def set_bad_1(x):
-      if not x.name in bad: bad[x.name] = 1
-    def inc_bad_1(x):
-      if not x.name in bad: bad[x.name] += 1 #TODO: Bug? Won't matter if we are postprocessing to find badness.
-
-    tmp_bad = pd.Series(data = False, index = joined.index)
-    for c in set(get_flows(workflow)) - set(get_number_flows(workflow)):
-      tmp_bad = tmp_bad | joined[c].str.contains('^0+$')
-    tmp_bad[tmp_bad].to_frame().apply(inc_bad_1, axis = 1)
-
-    #Note that it may be that only part of the uncertainty identifier has survived autoresolution.
-    #For this reason, we cannot use the exact same patterns as in the pre-resultion function 'uncertainty'.
-    tmp_bad = pd.Series(data = False, index = joined.index)
-    for pattern in [
-      r'[\[\]\{\}]', #Any sort of bracket (apart from round, which come up too much in correct contexts)
-      r'\.\.', #More than one '.' in succession
-      r'\?' #A question mark
-      #r'[^\d]*\.[^ \d$]', #A single dot that (a) does not appear to be part of a number and (b) does not appear to be a full stop. Did away with this one as it matches dots in abbreviations and initials -- far too noisy.
-    ]:
-      for c in get_flows(workflow):
-        tmp_bad = tmp_bad | joined[c].str.contains(pattern)
-    tmp_bad[tmp_bad].to_frame().apply(set_bad_1, axis = 1)
-    track('* Transcriptionisms identified')
+  transcriptionisms, matches = transcriptionism_flags(joined, workflow, workflow_columns)
+  if matches is not None:
+    report = matches.stack().rename('pattern').rename_axis(KEYS + ['field']).to_frame()
+    report['value'] = [joined.at[k[:2], k[2]] for k in report.index]
+    report.to_csv(f'{args.output_dir}/transcriptionisms.csv')
+    track('* Transcriptionisms identified', rows = len(joined.index))
     dump_interim(joined, 'joined_has_transcriptionisms')
 
   #Tag or remove the rows with badness
   joined.insert(len(joined.columns), 'Problems', '')
-  joined['Problems'] = joined[workflow_columns].isnull().values.any(axis = 1)
-  if len(vol_1_subj_ids) != 0:
-    joined.loc[vol_1_subj_ids,['Problems']] = joined.loc[vol_1_subj_ids][workflow_columns].drop('port sailed out of', axis = 1).isnull().values.any(axis = 1)
-  joined['Problems'] = joined['Problems'].map({True: 'Blank(s)', False: ''})
+  joined['Problems'] = blank_fields(joined, workflow_columns, vol_1_subj_ids).map({True: 'Blank(s)', False: ''})
   dump_interim(joined, 'joined_problems')
-  track('* Badness identified')
+  track('* Badness identified', rows = len(joined.index))
 
   #The following code assumes equal indices, so confirm that this is still the case.
   #(We earlier checked for equality and uniqueness. We do not do anything that should
@@ -734,42 +1275,35 @@ def main():
   #dataframes.
   if not joined.index.equals(joined_views.index): raise Exception('joined index differs from joined_views index (equals)')
   if not args.unfinished:
-    incomplete_subjects = []
-    for sid in joined_views.index.get_level_values('subject_id').unique():
-      page_completes = joined_views.loc[[sid]]['complete']
-      if (not page_completes.all()) or not(len(page_completes) == 25):
-        incomplete_subjects.append(sid)
-
-    incomplete_joined = joined.query(f'subject_id in @incomplete_subjects')
-    incomplete_joined.to_csv(f'{args.output_dir}/incomplete_pages.csv')
-    for key in incomplete_joined.index.unique().to_numpy():
-      bad.pop(key, None)
-      autoresolved.pop(key, None)
-
-    joined = joined.drop(incomplete_joined.index)
-    dump_interim(joined, 'joined_unfinished')
-    dump_interim(joined_views, 'joined_views_unfinished')
-    track('* Incompletes removed')
+    pages = page_completeness(joined_views, workflow[args.workflow_set].get('rows_per_page', 25)) #Not every workflow set in workflow.yaml gives rows_per_page
+    pages.to_csv(f'{args.output_dir}/page_completeness.csv')
 
+    incomplete_mask = joined.index.get_level_values('subject_id').isin(pages.index[~pages['complete']])
+    joined[incomplete_mask].to_csv(f'{args.output_dir}/incomplete_pages.csv')
 
-  #Tag unresolved unresolved fields
-  #TODO This part does not feel like the Pandas way
-  for b in bad.keys():
-    problems = joined.at[b, 'Problems']
-    if len(problems):
-      joined.at[b, 'Problems'] = f'{problems} & at least {bad[b]} unresolved fields'
-    else:
-      joined.at[b, 'Problems'] = f'At least {bad[b]} unresolved fields'
-  track('* Unresolved identified')
+    joined = joined[~incomplete_mask]
+    dump_interim(joined, 'joined_unfinished')
+    dump_interim(joined_views, 'joined_views_unfinished')
+    track('* Incompletes removed', rows = len(joined.index))
+
+
+  #Tag unresolved fields
+  unresolved = unresolved.reindex(joined.index)
+  transcriptionisms = transcriptionisms.reindex(joined.index)
+  counts = unresolved_counts(unresolved, transcriptionisms)
+  unresolved_text = counts.astype(str) + ' unresolved fields'
+  has_blanks = joined['Problems'].ne('')
+  joined['Problems'] = joined['Problems'].mask(counts.gt(0) & has_blanks, joined['Problems'] + ' & at least ' + unresolved_text)
+  joined['Problems'] = joined['Problems'].mask(counts.gt(0) & ~has_blanks, 'At least ' + unresolved_text)
+  track('* Unresolved identified', rows = len(joined.index))
   dump_interim(joined, 'joined_unresolved')
 
 
   #Record where there was autoresolution
-  joined.insert(len(joined.columns), 'Autoresolved', '')
-  #TODO: Again, doesn't feel like Pandas
-  for index, value in autoresolved.items():
-    joined.at[index, 'Autoresolved'] = '; '.join(filter(lambda x: x in value.keys(), workflow_columns))
-  track('* Autos identified')
+  joined.insert(len(joined.columns), 'Autoresolved', flagged_fields(autos.reindex(joined.index)[workflow_columns]))
+  if args.unresolved_column:
+    joined.insert(len(joined.columns), 'Unresolved', flagged_fields((unresolved | transcriptionisms)[workflow_columns]))
+  track('* Autos identified', rows = len(joined.index))
   dump_interim(joined, 'joined_autos')
 
   #joined.csv is complete: now sort it
@@ -808,7 +1342,19 @@ def main():
       print("means that you have rerun something where you already had a views file.", file = sys.stderr)
       raise e
   joined_views.to_csv(path_or_buf = views_file)
+  if args.flow_counts: dump_flow_counts()
 
-  track('* All done')
+  track('* All done', rows = len(joined.index))
+  if args.timing:
+    with open(f'{args.output_dir}/profile.json', 'w') as f:
+      json.dump({
+        'args': sys.argv,
+        'jobs': args.jobs,
+        'notes': {
+          'process_peak_rss_kib': 'Peak RSS of the process (a --jobs worker, for workflow stages) from its start to the end of the stage. This is cumulative, not the peak within the stage.',
+          'peak_rss_growth_kib': 'How much the stage raised process_peak_rss_kib. 0 means that the stage stayed below an earlier peak, not that it used no memory.',
+        },
+        'stages': track.stages,
+      }, f, indent = 2)
 
 main()
@@ -3,75 +3,32 @@ import pandas as pd
 import re
 import sys
 import shutil
+import argparse
+import functools
+import yaml
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, Future
 from decimal import Decimal, ROUND_HALF_UP
-import dateutil
-import datetime
+import extraction_io
+import dates
 
 adminrefs = set()
 
+#Maximum number of distinct (workflow, value) pairs to remember the cleaned form of. The cache lasts for as long as
+#the process does, so it is shared by all the files cleaned in a run.
+CACHE_SIZE = 1 << 18
+
 def strip(x):
   return x.strip()
 
-def hill_navy(text):
-  return re.sub(r'hill(\s*navy)\b', 'HM\g<1>', text, flags = re.IGNORECASE)
-
-def normalise_case(text):
-  result = text
-  #Title case (all words start with a capital letter, rest is lowercase)
-  #Sometimes there is a sentence instead of a placename, so just guess that anything
-  #longer than 4 words is a sentence and leave it alone.
-  #Some common words can be mis-cased by this, so we fix them up.
-  #Perhaps we should just standardise case entirely for the string-matching benefits
-  if len(result.split()) < 5:
-    result = result.title()
-    
-    #Some case cleanup for exceptions
-
-    #Make very short words lower case
-    result = re.sub(r'\bA\b', 'a', result)
-    result = re.sub(r'\ba\.', 'A.', result) #Don't lowercase A if it is followed by a full stop
-    result = re.sub(r'\bOf\b', 'of', result)
-    result = re.sub(r'\bOn\b', 'on', result)
-    result = re.sub(r'\bDe\b', 'de', result)
-    result = re.sub(r'\bAt\b', 'at', result)
-    result = re.sub(r'\bThe\b', 'the', result)
-    
-    #Fix known abbreviations
-    result = re.sub(r'\bUs\b', 'US', result)
-    result = re.sub(r'\bUsa\b', 'USA', result)
-    result = re.sub(r'\bSs\b', 'SS', result)
-    result = re.sub(r'\bSb\b', 'SB', result)
-    result = re.sub(r'\bNs\b', 'NS', result)
-    result = re.sub(r'\bNb\b', 'NB', result)
-    result = re.sub(r'\bNa\b', 'NA', result)
-    result = re.sub(r'\bAb\b', 'AB', result)
-    result = re.sub(r'\bNj\b', 'NJ', result)
-
-    #Allow for Mc/Mac
-    result = re.sub(r'\b(Ma?c)([a-z])', lambda x: f'{x[1]}{x[2].upper()}', result)
-
-    #Common exceptions
-    result = re.sub(r'\bUpon\b', 'upon', result)
-
-    #Lower case following certain punctuation
-    result = re.sub(r'\.\.\.[A-Z]', lambda x: x[0].lower(), result)
-    result = re.sub(r'[\[\]{}\'][A-Z]', lambda x: x[0].lower(), result)
-
-    #Upper case following certain punctuation
-    result = re.sub(r'\b[Ll]\'[a-z]', lambda x: x[0].upper(), result) #e.g. L'Orient
-    result = re.sub(r'-[a-z]', lambda x: x[0].upper(), result) #e.g. West-Ham
-
-  #First character is always upper case
-  result = re.sub(r'^\'?[a-z]', lambda x: x[0].upper(), result) #The 'possible quote' at the beginning is just to deal with 'New Hampshire, which was annoying me.
-  return result
-
-
+CROSSREF = re.compile(r'\b\d+\s*$')
 def strip_crossref(text):
   #Check for possible reference to another admission.
   #If it is there, log it and strip it
   global adminrefs
   result = text
-  number = re.search(r'\b\d+\s*$', result)
+  number = CROSSREF.search(result)
   if number:
     adminrefs.add(f'{number[0]} from cell(s) reading "{text}"')
     #result = re.sub(r'\s*\d+\s*$', '', result)
@@ -79,19 +36,6 @@ def strip_crossref(text):
   return result
 
 
-#Place of Birth
-def clean_18617(text):
-  #chomp whitespace (Panoptes extraction doesn't do this)
-  result = text.strip()
-  result = normalise_case(result)
-  result = strip_crossref(result)
-
-  #Drop everything to the right of a comma (inclusive of the comma)
-  result = re.sub(r'\s*,.*$', '', result)
-
-  return hill_navy(result)
-
-
 #Years at Sea
 def clean_18619(years):
   def round_to_month(x):
@@ -184,29 +128,62 @@ def clean_18619(years):
   if len(numbers) != 2: return years
   return ';'.join([round_to_month(x) for x in numbers])
 
+#Rounding of the decimal part of a years at sea value, as clean_18619 does it, for every decimal part of up to
+#three digits (with trailing zeros removed). Maps the digits after the point to the digits after the point in the
+#rounded value, or to '' if it rounds down to a whole number of years. Decimal parts that clean_18619 rejects are
+#left out, as are longer ones: clean_18619_bulk leaves these to clean_18619.
+def month_fractions():
+  fractions = {}
+  for length in range(1, 4):
+    for n in range(10 ** length):
+      digits = f'{n:0{length}}'
+      if digits.endswith('0'): continue
+      try: fractions[digits] = clean_18619(f'0.{digits}')[3:] #Drop the leading '00.'
+      except Exception: pass
+  return fractions
+MONTH_FRACTIONS = month_fractions()
+
+#Years at Sea, for many values at once. Gives the same results as mapping clean_18619 over years.
+#Each distinct value is cleaned once. Values in the usual forms -- a number, or two numbers separated by one of
+#;:, -- where each number is digits with an optional decimal part (or is blank or zeros), are parsed with a
+#single pattern, with the decimal parts rounded by looking them up in MONTH_FRACTIONS. Anything else goes
+#through clean_18619.
+YEARS_PAIR = re.compile(r'([^;:,]*)[;:,]([^;:,]*)')
+YEARS_NUMBER = re.compile(r'([0-9]*)(?:\.([0-9]*))?')
+YEARS_ZERO = re.compile(r'[oO0 ]*')
+def clean_18619_bulk(years):
+  #As clean_18619's round_to_month, or None if x is not in one of the usual forms
+  def round_to_month(x):
+    if YEARS_ZERO.fullmatch(x): return '00'
+    number = YEARS_NUMBER.fullmatch(x)
+    if not number or not (number[1] or number[2]): return None
+    integer_part = number[1].lstrip('0').zfill(2)
+    decimal_part = (number[2] or '').rstrip('0')
+    if not decimal_part: return integer_part
+    rounded = MONTH_FRACTIONS.get(decimal_part)
+    if rounded is None: return None
+    return f'{integer_part}.{rounded}' if rounded else integer_part
+
+  def clean(x):
+    pair = YEARS_PAIR.fullmatch(x)
+    if pair:
+      first, second = round_to_month(pair[1].strip()), round_to_month(pair[2].strip())
+      if first is not None and second is not None: return f'{first};{second}'
+    elif len(x.strip()) == 0: return ''
+    else:
+      result = round_to_month(x)
+      if result is not None: return result
+    return clean_18619(x)
 
-#Last Services
-def clean_18621(text):
-  result = clean_text(text)
-
-  result, count = re.subn(r'^Hms Ms\b', 'HMS', result, flags = re.IGNORECASE)
-  if count != 0: return result
-  result, count = re.subn(r'^Hms\b',    'HMS', result, flags = re.IGNORECASE)
-  if count != 0: return result
-  result, count = re.subn(r'^Hcs\b',    'HCS', result, flags = re.IGNORECASE)
-  if count != 0: return result
-  return result
-
-
-def clean_text(text):
-  return strip_crossref(hill_navy(normalise_case(strip(text))))
+  return extraction_io.map_distinct(years, clean)
 
 
+ALL_ZEROS = re.compile(r'^[oO0]+$')
 def unstring_number(text):
   result = strip(text)
   try: float(result)
   except ValueError:
-    if re.match(r'^[oO0]+$', text): return '0'
+    if ALL_ZEROS.match(text): return '0'
     else: return ''
   return result
 
@@ -231,67 +208,255 @@ def unstring_date(text):
   if 0 in parts:
     return '-'.join([str(x) for x in parts]) #Just return this, preserving the zeros. The aggregator checks the candidates for those containing zeros. (The date parser, below, does not respect zero-fields.)
 
-  #dateutil.parser.parse is thrown off by leading zeros if that results in too many digits in a field
+  #dates.parse_date (like dateutil.parser.parse) is thrown off by leading zeros if that results in too many digits in a field
   result = re.sub(r'-0+', '-', result)
   result = re.sub(r'^0+', '', result)
 
-  try: result = dateutil.parser.parse(result, dayfirst = True)
+  try: result = dates.parse_date(result)
   except (TypeError, ValueError): return ''
   if result.year > 9999: return text #TODO: Change to 2200
   if result.year < 1800: return text #TODO: Change to mimimum date in data set
-  return result.strftime('%d-%m-%Y') #TODO: Change to maximum date in dataset (in phase two, this will be in the early 20th century)
-
-
-def main():
-  funcmap = {
-    '18611': unstring_number, #admission number
-    '18612': unstring_date, #date of entry
-    '18613': clean_text, #name
-    #'18614': #quality -- dropdown, nothing to normalise
-    '18616': unstring_number, #age
-    '18617': clean_18617, #place of birth -- some special handling for extra words
-    '18618': clean_text, #port sailed out of (becomes "where from" in phase2)
-    '18619': clean_18619, #years at sea -- some special handling for splitting the fields and rounding to 0.08
-    '18621': clean_18621, #last services -- some special handling for ship name abbreviations
-    '18622': clean_text, #under what circumstances admitted
-    '18623': unstring_date, #date of discharge
-    #'18624': #how disposed of -- dropdown, nothing to normalise
-    '18625': unstring_number, #number of days victualled
-    #phase 2 follows -- but only where it introduces new ID numbers #TODO: Look into whether any of these need special processing
-    '18344': clean_text, #creed
-    '18347': clean_text, #of what port -- so basically the same as 18618?
-    '18454': clean_text, #quality
-    '20285': clean_text, #how disposed of
-  }
-
-  for infile, cleanfunc in zip(sys.argv[1::2], sys.argv[2::2]):
-    outfile = f'{infile.split(".", 1)[0]}.cleaned.csv'
-    df = pd.read_csv(infile, keep_default_na = False, dtype = {
-      'classification_id': str,
-      'user_name': str,
-      'user_id': str,
-      'workflow_id': str,
-      'task': str,
-      'created_at': str,
-      'subject_id': str,
-      'extractor': str,
-      'data.text': str,
-      'data.value': str,
-      'data.gold_standard': str,
-      'data.aggregation_version': str
-    }, skip_blank_lines = False)
+  return dates.format_cleaned(result) #TODO: Change to maximum date in dataset (in phase two, this will be in the early 20th century)
+
+
+#Cleaning steps that are not simple substitutions, by the names that the cleaning rules in workflow.yaml use for them
+STEPS = {
+  'strip': strip,
+  'title_case': str.title,
+  'strip_crossref': strip_crossref,
+  'unstring_number': unstring_number,
+  'unstring_date': unstring_date,
+  'clean_18619': clean_18619, #years at sea -- some special handling for splitting the fields and rounding to 0.08
+}
+
+#Steps that can be done for many values at once. These give the same results as the corresponding
+#steps in STEPS (and find no crossrefs), but much more quickly.
+BULK_STEPS = {
+  'clean_18619': clean_18619_bulk,
+}
+
+#The cleaning rules for each workflow, compiled from the "cleaning" section of workflow.yaml by load_rules
+FUNCMAP = {}
+#Workflows whose rules are just a single step from BULK_STEPS, which clean_extraction uses instead of FUNCMAP
+BULK_FUNCMAP = {}
+#The rules that FUNCMAP was compiled from, so that worker processes can compile them too
+RULES = {}
+
+#Rule lists can contain rule lists (as when a YAML alias refers to a shared list of rules): flatten them out
+def flatten_rules(rules):
+  for rule in rules:
+    if isinstance(rule, list): yield from flatten_rules(rule)
+    else: yield rule
+
+def words_pattern(words):
+  return re.compile(r'\b(?:' + '|'.join([re.escape(x) for x in sorted(words, key = len, reverse = True)]) + r')\b')
+
+#True if replacing the words in both run and words in a single pass gives the same result as replacing those
+#in run and then those in words: that is, neither can match inside the other's words, nor inside run's replacements
+def can_merge(run, words):
+  return not (any([words_pattern(words).search(x) for x in list(run) + list(run.values())]) or
+              any([words_pattern(run).search(x) for x in words]))
+
+def compile_words(words):
+  pattern = words_pattern(words)
+  return lambda text: pattern.sub(lambda x: words[x[0]], text)
+
+def compile_prefixes(prefixes, flags):
+  replacements = list(prefixes.values())
+  pattern = re.compile('^(?:' + '|'.join([f'({re.escape(x)})' for x in prefixes]) + r')\b', flags)
+  return lambda text: pattern.sub(lambda x: replacements[x.lastindex - 1], text)
+
+def compile_regex(rule, flags):
+  pattern = re.compile(rule['regex'], flags)
+  if 'case' in rule:
+    if rule['case'] == 'upper': return lambda text: pattern.sub(lambda x: x[0].upper(), text)
+    if rule['case'] == 'lower': return lambda text: pattern.sub(lambda x: x[0].lower(), text)
+    raise Exception(f'Bad case "{rule["case"]}" in cleaning rule {rule}: should be "upper" or "lower"')
+  replacement = rule['replace']
+  return lambda text: pattern.sub(replacement, text)
+
+def compile_short_text(limit, rules, merge):
+  pipeline = compile_rules(rules, merge)
+  return lambda text: pipeline(text) if len(text.split()) < limit else text
+
+#Compile a list of cleaning rules, as given in workflow.yaml, into a function that applies them in order.
+#Each rule is one of:
+#  * the name of a step in STEPS
+#  * {words: {word: replacement, ...}}: replace these whole words, case-sensitively, in a single pass
+#  * {prefixes: {prefix: replacement, ...}}: replace the first of these that the text begins with, if any
+#  * {regex: pattern, replace: replacement}: as re.sub
+#  * {regex: pattern, case: upper}, or lower: change the case of whatever the pattern matches
+#  * {fewer_words_than: N, rules: [...]}: apply these rules only to text of fewer than N words
+#prefixes and regex rules can also have "ignore_case: true".
+#Runs of words rules are merged, so that one regex finds all of their words, so long as that gives the same result
+#as applying them one after another (see can_merge). merge = False turns this off, for testing.
+#The returned function has the compiled steps in its steps attribute.
+def compile_rules(rules, merge = True):
+  merged = [] #Rules, with runs of words rules merged into a single dict
+  for rule in flatten_rules(rules):
+    if isinstance(rule, dict) and 'words' in rule:
+      if merge and merged and isinstance(merged[-1], dict) and 'words' in merged[-1] and can_merge(merged[-1]['words'], rule['words']):
+        merged[-1]['words'].update(rule['words'])
+      else: merged.append({'words': dict(rule['words'])})
+    else: merged.append(rule)
+
+  steps = []
+  for rule in merged:
+    if isinstance(rule, str) and rule in STEPS: steps.append(STEPS[rule])
+    elif not isinstance(rule, dict): raise Exception(f'Unknown cleaning step "{rule}"')
+    elif 'words' in rule: steps.append(compile_words(rule['words']))
+    elif 'prefixes' in rule: steps.append(compile_prefixes(rule['prefixes'], re.IGNORECASE if rule.get('ignore_case') else 0))
+    elif 'regex' in rule: steps.append(compile_regex(rule, re.IGNORECASE if rule.get('ignore_case') else 0))
+    elif 'fewer_words_than' in rule: steps.append(compile_short_text(rule['fewer_words_than'], rule['rules'], merge))
+    else: raise Exception(f'Bad cleaning rule {rule}')
+
+  def pipeline(text):
+    for step in steps: text = step(text)
+    return text
+  pipeline.steps = steps
+  return pipeline
+
+#Clean a single value with the rules for workflow cleanfunc, remembering the result.
+#Returns the cleaned value and the possible crossrefs that cleaning it found, so that a
+#cached value can add its crossrefs to adminrefs just as cleaning it afresh would.
+@functools.lru_cache(maxsize = CACHE_SIZE)
+def clean_value(cleanfunc, text):
+  global adminrefs
+  all_refs = adminrefs
+  adminrefs = set() #Collect just this value's crossrefs
+  try:
+    return FUNCMAP[cleanfunc](text), frozenset(adminrefs)
+  finally:
+    adminrefs = all_refs
+
+#Compile the cleaning rules for each workflow (the "cleaning" section of workflow.yaml) into FUNCMAP and BULK_FUNCMAP.
+#This must be done before cleaning anything.
+def load_rules(rules):
+  FUNCMAP.clear()
+  BULK_FUNCMAP.clear()
+  RULES.clear()
+  clean_value.cache_clear()
+  for w_id, w_rules in rules.items():
+    w_rules = list(flatten_rules(w_rules))
+    FUNCMAP[str(w_id)] = compile_rules(w_rules)
+    if len(w_rules) == 1 and isinstance(w_rules[0], str) and w_rules[0] in BULK_STEPS:
+      BULK_FUNCMAP[str(w_id)] = BULK_STEPS[w_rules[0]]
+    RULES[w_id] = w_rules
+
+def read_rules(workflow_defs):
+  with open(workflow_defs) as f:
+    return yaml.load(f, Loader = yaml.Loader)['cleaning']
+
+#Clean the transcriptions in an extraction. cleanfunc is the id of the workflow, which selects the
+#cleaning rules from FUNCMAP (see load_rules). Dropdown extractions are returned as they are.
+#Possible crossrefs found along the way are added to adminrefs.
+#Most values recur many times (blank cells, common names, ports and ships), so each distinct
+#value is cleaned only once and the results are mapped back onto the rows.
+def clean_extraction(df, cleanfunc):
+  if 'data.text' in df.columns:
+    df = df.copy()
+    #strip out entries that mean 'empty cell'
+    df['data.text'] = df['data.text'].str.replace(r'^\s*no (row|entry|file|blank)\s*$', '', regex = True, case = False)
+
+    #workflow-specific cleanup
+    if str(cleanfunc) not in FUNCMAP: raise Exception(f'No cleaning rules for workflow {cleanfunc} (see the "cleaning" section of workflow.yaml)')
+    uniques = df['data.text'].unique()
+    if str(cleanfunc) in BULK_FUNCMAP:
+      cleaned = dict(zip(uniques, BULK_FUNCMAP[str(cleanfunc)](uniques)))
+    else:
+      cleaned = {}
+      for text in uniques:
+        cleaned[text], refs = clean_value(str(cleanfunc), text)
+        adminrefs.update(refs)
+    df['data.text'] = df['data.text'].map(cleaned)
+    return df
+  elif 'data.value' in df.columns:
+    return df
+  else: raise Exception
+
+
+#Clean one chunk of an extraction, returning the cleaned chunk and the possible crossrefs found in it.
+#This is what runs in the worker processes when cleaning in parallel.
+def clean_chunk(df, cleanfunc):
+  adminrefs.clear()
+  return clean_extraction(df, cleanfunc), set(adminrefs)
+
+#Yield (outfile, chunk, cleanfunc) for the text extractions in pairs, in order and chunksize rows at a time (or a
+#whole file at a time if chunksize is None). Dropdown extractions have nothing to clean, so are just copied.
+#CSV files are read a chunk at a time. Columnar files can only be read whole, so are split up after reading.
+def read_chunks(pairs, chunksize):
+  csv_args = {'keep_default_na': False, 'skip_blank_lines': False}
+  dtype = {k: str for k in extraction_io.EXTRACTION_DTYPES}
+  for infile, cleanfunc in pairs:
+    outfile = f'{infile.split(".", 1)[0]}.cleaned{extraction_io.extension(infile)}' #Same format as the input
+    if extraction_io.extension(infile) == '.csv':
+      columns = pd.read_csv(infile, nrows = 0).columns
+      if 'data.text' in columns and chunksize:
+        chunks = 0
+        for chunk in extraction_io.read_extraction(infile, dtype = dtype, chunksize = chunksize, **csv_args):
+          chunks += 1
+          yield outfile, chunk, cleanfunc
+        if chunks == 0: #A file with a header but no rows may give no chunks at all, but should still give an output file with a header
+          yield outfile, extraction_io.read_extraction(infile, dtype = dtype, nrows = 0, **csv_args), cleanfunc
+        continue
+    df = extraction_io.read_extraction(infile, dtype = dtype, **csv_args)
     if 'data.text' in df.columns:
-      #strip out entries that mean 'empty cell'
-      df['data.text'] = df['data.text'].str.replace(r'^\s*no (row|entry|file|blank)\s*$', '', regex = True, case = False)
-
-      #workflow-specific cleanup
-      df['data.text'] = df['data.text'].map(funcmap[cleanfunc])
-
-      df.to_csv(outfile, index = False)
+      if not chunksize: yield outfile, df, cleanfunc
+      else:
+        for start in range(0, max(len(df), 1), chunksize): yield outfile, df.iloc[start:start + chunksize], cleanfunc
     elif 'data.value' in df.columns:
       shutil.copyfile(infile, outfile)
     else: raise Exception
 
-  print('Possible crossrefs:', sorted(adminrefs))
+#Clean the extractions in pairs of (infile, cleanfunc), writing each to its .cleaned file, and return the possible
+#crossrefs found. With jobs > 1, chunks are cleaned in parallel worker processes, while the results are written
+#back in their original order. At most 2 * jobs chunks are in flight at once, so with chunksize set, memory use
+#depends upon chunksize rather than upon the size of the files. Columnar outputs must be written whole, though.
+def clean_files(pairs, jobs = 1, chunksize = None):
+  found = set()
+  csv_outputs = {}      #outfile -> open file, for CSV outputs, which are written a chunk at a time
+  columnar_outputs = {} #outfile -> list of cleaned chunks, for columnar outputs
+
+  def write(outfile, result):
+    df, refs = result.result() if isinstance(result, Future) else result
+    found.update(refs)
+    if extraction_io.extension(outfile) == '.csv':
+      if outfile not in csv_outputs:
+        csv_outputs[outfile] = open(outfile, 'w', newline = '')
+        df.to_csv(csv_outputs[outfile], index = False)
+      else:
+        df.to_csv(csv_outputs[outfile], index = False, header = False)
+    else:
+      columnar_outputs.setdefault(outfile, []).append(df)
+
+  try:
+    with ProcessPoolExecutor(jobs, initializer = load_rules, initargs = (dict(RULES),)) if jobs > 1 else nullcontext() as executor:
+      pending = deque()
+      for outfile, chunk, cleanfunc in read_chunks(pairs, chunksize):
+        if executor: pending.append((outfile, executor.submit(clean_chunk, chunk, cleanfunc)))
+        else: pending.append((outfile, clean_chunk(chunk, cleanfunc)))
+        if len(pending) >= 2 * jobs: write(*pending.popleft())
+      while pending: write(*pending.popleft())
+  finally:
+    for f in csv_outputs.values(): f.close()
+  for outfile, dfs in columnar_outputs.items():
+    extraction_io.write_extraction(pd.concat(dfs), outfile)
+  return found
 
-main()
+def main():
+  parser = argparse.ArgumentParser(description = 'Clean the transcriptions in extraction files, writing each to a corresponding .cleaned file. Dropdown extractions are copied unchanged.')
+  parser.add_argument('pairs', nargs = '+', metavar = 'extraction workflow_id', help = 'Pairs of extraction file and the id of the workflow whose cleaning rules to apply to it')
+  parser.add_argument('--workflow_defs', default = 'workflow.yaml', help = 'File defining the workflows, including their cleaning rules (default: workflow.yaml)')
+  parser.add_argument('--jobs', '-j', type = int, default = 1, help = 'Number of processes to clean with. Chunks of the files (see --chunksize) are shared out between the processes, and written back in their original order. (default: 1)')
+  parser.add_argument('--chunksize', type = int, help = 'Clean the files this many rows at a time, so that memory use depends upon this rather than upon the size of the files, and so that a large file can be cleaned by several processes at once. Feather and Parquet files are still read and written whole. (default: each file is cleaned in one go)')
+  args = parser.parse_args()
+  if len(args.pairs) % 2: parser.error('extractions and workflow ids must come in pairs')
+  if args.jobs < 1: parser.error('--jobs must be at least 1')
+  if args.chunksize is not None and args.chunksize < 1: parser.error('--chunksize must be at least 1')
+
+  load_rules(read_rules(args.workflow_defs))
+  found = clean_files(list(zip(args.pairs[0::2], args.pairs[1::2])), args.jobs, args.chunksize)
+  print('Possible crossrefs:', sorted(found))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+#Date parsing shared by clean_extraction.py, aggregate.py and mimsify.py.
+#Nearly every date that we see is a plain day-month-year like 17-03-1826, and dateutil's general-purpose
+#parser is very slow for these. So we handle that shape with a compiled regex and only fall back to dateutil
+#for anything else, giving exactly the same results (and the same exceptions) as dateutil would.
+import re
+import datetime
+import functools
+import dateutil.parser
+import extraction_io
+
+CACHE_SIZE = 1 << 16
+
+#Format of the dates that aggregate.py writes out, e.g. Apr 01 1800
+RESOLVED_FORMAT = '%b %d %Y'
+#Format of the dates that clean_extraction.py writes out and that Mimsy wants, e.g. 01-04-1800
+CLEANED_FORMAT = '%d-%m-%Y'
+
+#Day and month of one or two digits and a four-digit year, with the same separator between each.
+#Within these limits, and with the month in range, dateutil reads the fields as day, month, year
+#(checked exhaustively by testing/test_dates.sh).
+DAY_MONTH_YEAR = re.compile(r'(\d{1,2})([-/\.=])(\d{1,2})\2(\d{4})')
+#As strptime reads RESOLVED_FORMAT in the C locale
+RESOLVED = re.compile(r'([A-Z][a-z]{2}) (\d{2}) (\d{4})')
+MONTHS = {x: i + 1 for i, x in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+#Same as dateutil.parser.parse(text, dayfirst = True), but with '=' read as '-' (transcribers often type '='
+#for '-'). Raises whatever dateutil raises for text that is not a date.
+@functools.lru_cache(maxsize = CACHE_SIZE)
+def parse_date(text):
+  match = DAY_MONTH_YEAR.fullmatch(text)
+  if match:
+    day, month, year = int(match[1]), int(match[3]), int(match[4])
+    if 1 <= month <= 12 and year > 0:
+      try: return datetime.datetime(year, month, day)
+      except ValueError: pass #Let dateutil decide what to do with a bad day
+  return dateutil.parser.parse(text.replace('=', '-'), dayfirst = True)
+
+#parse_date over a Series (or any list-like) of strings, parsing each distinct value once.
+#Returns a Series of datetimes with the same index, with None wherever parse_date raises TypeError or ValueError.
+def parse_dates(values):
+  def parse(x):
+    try: return parse_date(x)
+    except (TypeError, ValueError): return None
+  return extraction_io.map_distinct(values, parse)
+
+#Same as datetime.strptime(text, RESOLVED_FORMAT), raising ValueError if text is not in that format
+@functools.lru_cache(maxsize = CACHE_SIZE)
+def parse_resolved(text):
+  match = RESOLVED.fullmatch(text)
+  if match and match[1] in MONTHS:
+    try: return datetime.datetime(int(match[3]), MONTHS[match[1]], int(match[2]))
+    except ValueError: pass
+  return datetime.datetime.strptime(text, RESOLVED_FORMAT)
+
+def format_resolved(date):
+  return date.strftime(RESOLVED_FORMAT)
+
+def format_cleaned(date):
+  return date.strftime(CLEANED_FORMAT)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#Index of a Zooniverse classification export, kept in a sidecar file alongside the export so that
+#we only need to parse the export once. The index records, for each workflow version in the export,
+#how many classifications it has and the byte ranges of the file that they occupy, along with the
+#row count and the range of classification ids in the export as a whole.
+#The sidecar is reused for as long as the export's content hash still matches.
+import io
+import os
+import re
+import sys
+import csv
+import json
+import hashlib
+
+INDEX_VERSION = 1 #Bump this if the layout of the index changes
+INDEX_DIR = '.index'
+BLOCK_SIZE = 1 << 20
+
+def sidecar(fnam):
+  return os.path.join(os.path.dirname(fnam), INDEX_DIR, os.path.basename(fnam) + '.json')
+
+def content_hash(fnam):
+  digest = hashlib.sha256()
+  with open(fnam, 'rb') as f:
+    while block := f.read(BLOCK_SIZE):
+      digest.update(block)
+  return digest.hexdigest()
+
+#One sequential read of an export, in constant memory.
+#Returns the number of lines, the size in bytes, the byte offset at which the final line starts, the sha256 of
+#the content and the last tail_lines lines. The last lines come from a read back from the end of the file, so that
+#we do not have to keep them as we go.
+def export_info(fnam, tail_lines):
+  digest = hashlib.sha256()
+  lines = 0
+  size = 0
+  last = b''
+  with open(fnam, 'rb') as f:
+    while block := f.read(BLOCK_SIZE):
+      digest.update(block)
+      lines += block.count(b'\n')
+      size += len(block)
+      last = block[-1:]
+    if size and last != b'\n': lines += 1 #Final line has no newline, but it is still a line
+
+    #Read back from the end until we have enough of the file to hold the tail, and the start of the final line
+    tail = b''
+    while len(tail) < size and tail.count(b'\n', 0, len(tail) - 1) < tail_lines:
+      offset = max(0, size - len(tail) - BLOCK_SIZE)
+      f.seek(offset)
+      tail = f.read(size - len(tail) - offset) + tail
+  final_line_offset = size - len(tail) + tail.rfind(b'\n', 0, len(tail) - 1) + 1
+  #If we did not read the whole file, the first line in tail may be incomplete, and may even start part way through
+  #a multi-byte character, so drop it before decoding
+  if len(tail) < size: tail = tail[tail.index(b'\n') + 1:]
+  #Decode in the same way as reading the file in text mode, so that the lines are split as before
+  tail = io.TextIOWrapper(io.BytesIO(tail)).readlines()
+  return {
+    'lines': lines,
+    'bytes': size,
+    'final_line_offset': final_line_offset,
+    'sha256': digest.hexdigest(),
+    'tail': tail[-tail_lines:],
+  }
+
+#True if fnam looks like a classification export (as opposed to, say, the subjects or workflows export)
+def is_classification_export(fnam):
+  with open(fnam, newline = '') as f:
+    header = next(csv.reader(f), [])
+  return 'classification_id' in header and 'workflow_version' in header
+
+#One pass through the export.
+#Byte ranges are [start, end) and cover whole records (including their line endings), so that
+#header_bytes plus the ranges for a version form a valid CSV file of just that version's classifications.
+def build_index(fnam):
+  digest = hashlib.sha256()
+  pos = 0
+  def lines(f):
+    nonlocal pos
+    for line in f:
+      digest.update(line)
+      pos += len(line)
+      yield line.decode('utf-8')
+
+  index = {
+    'version': INDEX_VERSION,
+    'rows': 0,
+    'min_classification_id': None,
+    'max_classification_id': None,
+    'versions': {},
+  }
+  with open(fnam, 'rb') as f:
+    reader = csv.reader(lines(f))
+    header = next(reader, [])
+    index['header_bytes'] = pos
+    id_col = header.index('classification_id')
+    version_col = header.index('workflow_version')
+    start = pos
+    for row in reader:
+      if not row: #csv.DictReader skips blank rows, so we do too
+        start = pos
+        continue
+      classification_id = int(row[id_col])
+      index['rows'] += 1
+      if index['rows'] == 1 or classification_id < index['min_classification_id']: index['min_classification_id'] = classification_id
+      if index['rows'] == 1 or classification_id > index['max_classification_id']: index['max_classification_id'] = classification_id
+      version = index['versions'].setdefault(row[version_col], {'rows': 0, 'ranges': []})
+      version['rows'] += 1
+      ranges = version['ranges']
+      if ranges and ranges[-1][1] == start: ranges[-1][1] = pos #Extend a contiguous run
+      else: ranges.append([start, pos])
+      start = pos
+  index['sha256'] = digest.hexdigest()
+  return index
+
+#Return the index of the export in fnam, building it (and writing the sidecar) if there is no sidecar or the
+#export has changed since the sidecar was written. If the caller already knows the export's sha256 (as when
+#recording tranche info) it can pass it in to save hashing the export again.
+def get_index(fnam, sha256 = None):
+  stat = os.stat(fnam)
+  index = None
+  try:
+    with open(sidecar(fnam)) as f: index = json.load(f)
+  except (OSError, ValueError): pass
+  if index and index.get('version') == INDEX_VERSION:
+    if index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns and (sha256 is None or sha256 == index['sha256']):
+      return index
+    if index['size'] == stat.st_size and (sha256 or content_hash(fnam)) == index['sha256']:
+      index['mtime_ns'] = stat.st_mtime_ns #Touched but not changed
+      write_index(fnam, index)
+      return index
+
+  index = build_index(fnam)
+  index['size'] = stat.st_size
+  index['mtime_ns'] = stat.st_mtime_ns
+  write_index(fnam, index)
+  return index
+
+def write_index(fnam, index):
+  try:
+    os.makedirs(os.path.dirname(sidecar(fnam)), exist_ok = True)
+    with open(sidecar(fnam) + '.tmp', 'w') as f: json.dump(index, f, indent = 1)
+    os.replace(sidecar(fnam) + '.tmp', sidecar(fnam))
+  except OSError as e:
+    print(f'Warning: Could not write index for {fnam}: {e}', file = sys.stderr)
+
+def version_counts(index):
+  return {k: v['rows'] for k, v in index['versions'].items()}
+
+#The workflow versions in the index that "panoptes_aggregation extract" might take classifications from when asked
+#for version (major, minor): those with the same major version and the same or a later minor version. This may
+#be more than panoptes_aggregation actually uses, but never less, so a shard made from these versions gives the
+#same extraction as the whole export. Versions that are not in major.minor form are always included.
+def selected_versions(index, version):
+  selected = []
+  for v in index['versions']:
+    m = re.fullmatch(r'(\d+)\.(\d+)', v)
+    if not m or (int(m[1]) == version[0] and int(m[2]) >= version[1]):
+      selected.append(v)
+  return selected
+
+#True if extracting version (major, minor) from the whole export would read classifications that it does not use
+def would_skip_rows(index, version):
+  return sum([index['versions'][x]['rows'] for x in selected_versions(index, version)]) < index['rows']
+
+#Split the export into one shard per version, each holding the header and the classifications that
+#selected_versions picks out for that version, in their original order. shards maps (major, minor) to the
+#shard's file name. Each part of the export is read once, however many shards it goes to.
+def write_shards(fnam, index, shards):
+  ranges = {} #(start, end) -> shards that it goes to
+  for version, shard in shards.items():
+    for v in selected_versions(index, version):
+      for start, end in index['versions'][v]['ranges']:
+        ranges.setdefault((start, end), []).append(shard)
+
+  outputs = {shard: open(shard, 'wb') for shard in shards.values()}
+  try:
+    with open(fnam, 'rb') as f:
+      header = f.read(index['header_bytes'])
+      for out in outputs.values(): out.write(header)
+      for (start, end), targets in sorted(ranges.items()):
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+          block = f.read(min(BLOCK_SIZE, remaining))
+          if not block:
+            raise Exception(f'{fnam} is shorter than its index says that it should be')
+          for shard in targets: outputs[shard].write(block)
+          remaining -= len(block)
+  finally:
+    for out in outputs.values(): out.close()
@@ -2,7 +2,6 @@
 
 import os
 import re
-import csv
 import git
 import sys
 import math
@@ -12,11 +11,22 @@ import shutil
 import filecmp
 import argparse
 import subprocess
-from collections import Counter
+import time
+import json
+import hashlib
+import inspect
+import multiprocessing
+import importlib.metadata
 from datetime import datetime, timezone
-from multiprocessing import Process
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from enum import Enum
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 import subjects
+import extraction_io
+import export_index
+import strip_processed as strip_stage
+import pick_volumes as pick_stage
+import clean_extraction as clean_stage
 
 #globals
 args = None
@@ -31,6 +41,7 @@ class Phase(Enum):
   POST_EXTRACT = 'post_extract'
   REDUCE = 'reduce'
 DEFAULT_PHASES = [x.value for x in Phase]
+MANIFEST_VERSION = 1 #Bump this if the manifest layout or the way that step keys are computed changes
 
 def parse_args():
   parser = argparse.ArgumentParser()
@@ -51,6 +62,18 @@ def parse_args():
   parser.add_argument('--no_tranche',
                       action = 'store_true',
                       help = 'Do not generate tranche info. This does not prevent use of existing tranche info to eliminate previously-completed rows.')
+  parser.add_argument('--intermediate_format',
+                      choices = list(extraction_io.FORMATS),
+                      default = 'csv',
+                      help = 'File format for the .stripped, .vols and .cleaned files passed between the stages of extraction. feather and parquet are typed, columnar formats that are much faster to pass between stages than CSV, but need pyarrow to be installed. The outputs that other tools read (.vols.csv and the final extraction .csv) are always CSV. When re-running later phases with --phase, give the same format as the run that created the earlier stages\' outputs. (default: csv)')
+  parser.add_argument('--identity_sample',
+                      type = int,
+                      default = 1,
+                      help = 'Before stripping previously-processed rows, extract.py checks that stripping with no previously-processed rows gives back the extraction unchanged. Set this to N to check only every Nth row, which is quicker. (default: 1, check every row)')
+  parser.add_argument('--jobs', '-j',
+                      type = int,
+                      default = os.cpu_count(),
+                      help = 'Maximum number of steps to run at once. Each workflow is processed as a set of dependent steps, some of them per workflow version, and steps from all workflows share this many worker processes. (default: number of CPUs)')
   parser.add_argument('--phase',
                       nargs = '*',
                       choices = DEFAULT_PHASES,
@@ -59,6 +82,7 @@ def parse_args():
 
   global args
   args = parser.parse_args()
+  if args.identity_sample < 1: parser.error('--identity_sample must be at least 1')
 
 def get_version(v):
   #We pick out the parts with string operations, rather than converting to float, because of versions like "19.60"
@@ -84,26 +108,59 @@ def runit(subproc_args, logfile):
     with open(logfile, 'r') as f: print(''.join(['    ' + x for x in f.readlines()]), file = sys.stderr)
     raise e
 
+#In-process counterpart of runit: output from the body of the with statement goes to logfile
+@contextmanager
+def logged(description, logfile):
+  if args.verbose:
+    print(logfile + ':', description)
+  try:
+    with open(logfile, 'w') as f, redirect_stdout(f), redirect_stderr(f):
+      yield
+  except Exception:
+    print('*** The following step failed:', file = sys.stderr)
+    print('   ', description, file = sys.stderr)
+    with open(logfile, 'r') as f: print(''.join(['    ' + x for x in f.readlines()]), file = sys.stderr)
+    raise
+
+TRANCHE_TAIL_LINES = 10
+
+#export_index.export_info, plus the classification count and id range for classification exports. These come from the export's
+#index, which is built now if need be so that later lookups of workflow versions do not need to parse the export.
+def tranche_export_info(fnam):
+  info = export_index.export_info(fnam, TRANCHE_TAIL_LINES)
+  if export_index.is_classification_export(fnam):
+    index = export_index.get_index(fnam, info['sha256'])
+    info.update({k: index[k] for k in ['rows', 'min_classification_id', 'max_classification_id']})
+  return info
+
 def tranche_info():
   #Log number of lines in input files. This should allow me to recreate the exact same result by slicing the end off future downloads.
   tranchedir=f'tranches/{datetime.now(timezone.utc).strftime("%Y%m%d%H%M_GMT")}'
   os.mkdir(tranchedir)
+  exports = [f'{args.exports}/{x}' for x in sorted(os.listdir(args.exports))]
+  exports = [x for x in exports if os.path.isfile(x)] #Skip the directory of export indexes
+  with ProcessPoolExecutor(max(1, min(args.jobs, len(exports)))) as executor:
+    infos = list(executor.map(tranche_export_info, exports))
+
   with open(f'{tranchedir}/lines.txt', 'w') as f:
-    all_lines = 0
-    for export in sorted(os.listdir(f'{args.exports}')):
-      with open(f'exports/{export}') as g:
-        lines = len(g.readlines())
-        print(f'{lines:9} exports/{export}', file = f)
-        all_lines += lines
-    print(f'{all_lines:9} total', file = f)
+    for export, info in zip(exports, infos):
+      print(f'{info["lines"]:9} {export}', file = f)
+    print(f'{sum([x["lines"] for x in infos]):9} total', file = f)
 
   #Grab the last few classification ids as well, just in case
   with open(f'{tranchedir}/last_classifications.txt', 'w') as f:
-    for export in sorted(os.listdir(f'{args.exports}')):
-      with open(f'exports/{export}') as g:
-        print(f'==> exports/{export} <==', file = f)
-        print('\n'.join(map(lambda x: x[:x.find(',')], g.readlines()[-10:])), file = f)
-        print(file = f)
+    for export, info in zip(exports, infos):
+      print(f'==> {export} <==', file = f)
+      print('\n'.join(map(lambda x: x[:x.find(',')], info['tail'])), file = f)
+      print(file = f)
+
+  #Exact extent and content of each export. Truncating a later download of an export to 'bytes' should
+  #reproduce the file that we used, which can be checked against 'sha256'. 'rows' (and the classification id
+  #range) are only given for classification exports, and count classifications rather than lines.
+  index_cols = ['rows', 'min_classification_id', 'max_classification_id']
+  exports_df = pd.DataFrame([{'export': export, **{k: v for k, v in info.items() if k != 'tail'}} for export, info in zip(exports, infos)],
+                            columns = ['export', 'lines', 'bytes', 'final_line_offset', 'sha256'] + index_cols)
+  exports_df.astype({x: 'Int64' for x in index_cols}).to_csv(f'{tranchedir}/exports.csv', index = False)
 
   #Record git info about the script used to do the extraction
   #In the normal run of things I would expect this to be the same as that used for aggregate.py
@@ -209,19 +266,36 @@ def config_check_identity(w_id, versions, ztype):
     print('We rely upon these being the same to allow us to concatenate the extractions and reduce them together.', file = sys.stderr)
     raise Exception
 
-def panoptes_extract(w_id, versions, ztype, export_csv, extraction_name):
-  outputs = []
-  for major, minor in versions:
-    runit([
-      'panoptes_aggregation', 'extract',
-      f'{args.exports}/{export_csv}',
-      f'{args.output_dir}/Extractor_config_workflow_{w_id}_V{major}.{minor}.yaml',
-      '-d', args.output_dir,
-      '-o', f'{w_id}_V{major}_{minor}' #anything following a '.' in here appears to get discarded, so use _ instead
-      ],
-      f'{args.output_dir}/extract_{w_id}_V{major}.{minor}.log'
-    )
-    outputs.append(f'{args.output_dir}/{ztype}_extractor_{w_id}_V{major}_{minor}.csv')
+#Generate and fix up the configuration for one version of a workflow, as a single step
+def configure(w_id, version):
+  panoptes_config(w_id, [version])
+  config_fixups(w_id, [version])
+
+#The classifications for one version of a workflow, split out of the workflow's export by shard_export
+def shard_file(w_id, version):
+  return f'{args.output_dir}/classifications_{w_id}_V{version[0]}.{version[1]}.csv'
+
+#Split the export into a shard for each version, so that each run of panoptes_extract only has to read and
+#parse the classifications that it might use, rather than every classification in the export.
+def shard_export(w_id, versions, export_file):
+  export_index.write_shards(export_file, export_index.get_index(export_file), {v: shard_file(w_id, v) for v in versions})
+
+#export_file is either the workflow's export or, if it has been sharded, the shard for this version
+def panoptes_extract(w_id, version, export_file):
+  major, minor = version
+  runit([
+    'panoptes_aggregation', 'extract',
+    export_file,
+    f'{args.output_dir}/Extractor_config_workflow_{w_id}_V{major}.{minor}.yaml',
+    '-d', args.output_dir,
+    '-o', f'{w_id}_V{major}_{minor}' #anything following a '.' in here appears to get discarded, so use _ instead
+    ],
+    f'{args.output_dir}/extract_{w_id}_V{major}.{minor}.log'
+  )
+
+#Concatenate the per-version outputs of panoptes_extract into a single output {extraction_name}.full.csv
+def concatenate_extractions(w_id, versions, ztype, extraction_name):
+  outputs = [f'{args.output_dir}/{ztype}_extractor_{w_id}_V{major}_{minor}.csv' for major, minor in versions]
   shutil.copy(outputs.pop(0), extraction_name + '.full.csv')
   with open(extraction_name + '.full.csv', 'a') as concatenated_file:
     for output in outputs:
@@ -229,27 +303,31 @@ def panoptes_extract(w_id, versions, ztype, export_csv, extraction_name):
         f.readline() #do not copy extra header lines
         shutil.copyfileobj(f, concatenated_file)
 
-def strip_processed(w_id, views, input_name, logname, *extra_args):
-  runit([
-    './strip_processed.py',
-    '-t', views,
-    input_name
-    ] + list(extra_args),
-    f'{args.output_dir}/{logname}_{w_id}.log'
-  )
-
-def pick_volumes(w_id, input_name):
-  runit([
-    './pick_volumes.py', input_name,
-    '--first_volume', workflow_defs[args.workflow_set]['first_volume'],
-    '--final_volume', workflow_defs[args.workflow_set]['final_volume'],
-    '--subjects_cache', f'{args.output_dir}/subjects_metadata.csv'
-    ],
-    f'{args.output_dir}/pick_volumes_{w_id}.log'
-  )
-
-def clean_extraction(w_id, ztype, input_name):
-  runit(['./clean_extraction.py', input_name, w_id], f'{args.output_dir}/postextract_{w_id}.log')
+#The following stages work on the extraction in memory, each taking it from the stage before.
+#Each also writes its output to disk, for inspection and for later runs with --phase.
+def strip_processed(w_id, views, extraction_df, output_name, logname, sort = True):
+  with logged(f'strip_processed {views} -> {output_name}', f'{args.output_dir}/{logname}_{w_id}.log'):
+    stripped_df = strip_stage.strip_processed(extraction_df, strip_stage.read_tranche(views), sort)
+    extraction_io.write_extraction(stripped_df, output_name, float_format = '%.99g')
+    print(f"Removed {len(extraction_df) - len(stripped_df)} rows. Output ({'sorted' if sort else 'unsorted'}) in {output_name}.")
+  return stripped_df
+
+def pick_volumes(w_id, extraction_df, subjects_df, output_name):
+  first_volume = workflow_defs[args.workflow_set]['first_volume']
+  final_volume = workflow_defs[args.workflow_set]['final_volume']
+  with logged(f'pick_volumes {first_volume}-{final_volume} -> {output_name}', f'{args.output_dir}/pick_volumes_{w_id}.log'):
+    picked_df = pick_stage.pick_volumes(extraction_df, subjects_df, first_volume, final_volume, f'workflow {w_id}')
+    extraction_io.write_extraction(picked_df, output_name, float_format = '%.99g')
+    print(f'Removed {len(extraction_df) - len(picked_df)} wrong-volume rows to create {output_name} with {len(picked_df)} rows.')
+  return picked_df
+
+def clean_extraction(w_id, extraction_df, output_name):
+  with logged(f'clean_extraction {w_id} -> {output_name}', f'{args.output_dir}/postextract_{w_id}.log'):
+    clean_stage.adminrefs.clear()
+    cleaned_df = clean_stage.clean_extraction(extraction_df, w_id)
+    extraction_io.write_extraction(cleaned_df, output_name, float_format = '%.99g')
+    print('Possible crossrefs:', sorted(clean_stage.adminrefs))
+  return cleaned_df
 
 def panoptes_reduce(w_id, versions, ztype, input_name):
   major, minor = versions[0] #We already check in panoptes_config_identity that all reduction configs are the same
@@ -264,72 +342,270 @@ def panoptes_reduce(w_id, versions, ztype, input_name):
     f'{args.output_dir}/reduce_{w_id}.log'
   )
 
-def panoptes(w_id, w_data):
+def get_versions(w_id, w_data):
   if 'version' in w_data:
     if type(w_data['version']) is list:
       versions = list(map(get_version, w_data['version']))
     else:
       versions = [get_version(w_data['version'])]
   else: #get all actually-used versions by looking in the export file. Report on what is found.
-    with open(f"{args.exports}/{w_data['export']}", 'r') as export_file:
-      reader = csv.DictReader(export_file)
-      counted_versions = Counter([x['workflow_version'] for x in reader])
-      print(f'No workflow version(s) given for {w_id} ({w_data["name"]}). Will use the following detected workflow version(s):')
-      print('\n'.join([f'{k:>10}: {v:>8} instances' for k, v in counted_versions.items()]))
-      versions = [get_version(x) for x in counted_versions.keys()]
-  ztype = w_data['ztype']['type']
-  export_csv = w_data['export']
-
-  #The base name of the concatenation of all extractions for this workflow id
+    counted_versions = export_index.version_counts(export_index.get_index(f"{args.exports}/{w_data['export']}"))
+    print(f'No workflow version(s) given for {w_id} ({w_data["name"]}). Will use the following detected workflow version(s):')
+    print('\n'.join([f'{k:>10}: {v:>8} instances' for k, v in counted_versions.items()]))
+    versions = [get_version(x) for x in counted_versions.keys()]
+  return versions
+
+#Strip, pick volumes, clean and post-extract, as a single step. These hand the extraction from one to the next in memory.
+def prepare_extraction(w_id, w_data, subjects_df):
   extraction_name = get_extraction_name(w_id, w_data)
+  ext = extraction_io.FORMATS[args.intermediate_format] #Filename extension of the intermediate files
 
-  #These functions iterate per-version
-  if Phase.CONFIG.value in args.phase:
-    panoptes_config(w_id, versions)
-    config_fixups(w_id, versions)
-    config_check_identity(w_id, versions, ztype)
-
-  #This iterates per-version, but concatenates its results into a single output {extraction_name}.full.csv
-  if Phase.EXTRACT.value in args.phase:
-    panoptes_extract(w_id, versions, ztype, export_csv, extraction_name) #creates {extraction_name}.full.csv
+  #The output of each of the following stages is handed on to the next in memory. Where a stage has not been run, the
+  #next stage reads its output from disk instead.
+  stripped_df = vols_df = cleaned_df = None
+  read_extraction = lambda fnam: extraction_io.read_extraction(fnam, extraction_io.EXTRACTION_DTYPES, na_filter = False, index_col = False)
 
-  #Because we are working on the output of panoptes_extract, we are no longer version-sensitive
-
-  #This is a built-in check that strip_processed.py seems to be working as expected -- this should be an identity transform
   if Phase.STRIP_PROCESSED.value in args.phase:
-    strip_processed(w_id, 'tranches/empty_views.csv', f'{extraction_name}.full.csv', 'strip_identity_tranform_test', '--no_sort') #creates {extraction_name}.stripped.csv
-    subprocess.run(['diff', '-q', f'{extraction_name}.full.csv', f'{extraction_name}.stripped.csv'], check = True, capture_output = True)
+    full_df = read_extraction(f'{extraction_name}.full.csv')
+
+    #This is a built-in check that strip_processed.py seems to be working as expected -- this should be an identity transform
+    with logged(f'strip_processed identity check on {extraction_name}.full.csv', f'{args.output_dir}/strip_identity_tranform_test_{w_id}.log'):
+      checked = strip_stage.check_identity(f'{extraction_name}.full.csv', full_df, strip_stage.read_tranche('tranches/empty_views.csv'), args.identity_sample)
+      print(f'Identity transform confirmed on {checked} of {len(full_df)} rows.')
 
     #Whereas this will actually remove previously-completed rows of data
-    strip_processed(w_id, 'tranches/views.csv', f'{extraction_name}.full.csv', 'strip_seen') #creates {extraction_name}.stripped.csv
+    stripped_df = strip_processed(w_id, 'tranches/views.csv', full_df, f'{extraction_name}.stripped{ext}', 'strip_seen')
 
   if Phase.PICK_VOLUMES.value in args.phase:
-    pick_volumes(w_id, extraction_name + '.stripped.csv') #creates {extraction_name}.vols.csv
+    if stripped_df is None: stripped_df = read_extraction(f'{extraction_name}.stripped{ext}')
+    vols_df = pick_volumes(w_id, stripped_df, subjects_df, f'{extraction_name}.vols{ext}')
 
   if Phase.CLEAN.value in args.phase:
-    clean_extraction(w_id, ztype, extraction_name + '.vols.csv') #creates {extraction_name}.cleaned.csv
+    if vols_df is None: vols_df = read_extraction(f'{extraction_name}.vols{ext}')
+    cleaned_df = clean_extraction(w_id, vols_df, f'{extraction_name}.cleaned{ext}')
 
   if Phase.POST_EXTRACT.value in args.phase:
     #All extraction phases have run, copy the final output to the expected filename for extractions
-    shutil.copyfile(f'{extraction_name}.cleaned.csv', extraction_name + '.csv')
+    if ext == '.csv':
+      shutil.copyfile(f'{extraction_name}.cleaned.csv', extraction_name + '.csv')
+    else:
+      #Convert back to CSV for panoptes_aggregation reduce, and for aggregate.py (which also reads the .vols.csv)
+      if cleaned_df is None: cleaned_df = extraction_io.read_extraction(f'{extraction_name}.cleaned{ext}', {})
+      if vols_df is None: vols_df = extraction_io.read_extraction(f'{extraction_name}.vols{ext}', {})
+      extraction_io.write_extraction(cleaned_df, extraction_name + '.csv', float_format = '%.99g')
+      extraction_io.write_extraction(vols_df, extraction_name + '.vols.csv', float_format = '%.99g')
+
+#The steps for processing one workflow, as a dict of tasks for run_tasks, keyed by name.
+#Only steps for the phases that we are running are included, and so only dependencies upon those steps.
+def workflow_tasks(w_id, w_data, subjects_df):
+  versions = get_versions(w_id, w_data)
+  ztype = w_data['ztype']['type']
+  export_csv = w_data['export']
+
+  #The base name of the concatenation of all extractions for this workflow id
+  extraction_name = get_extraction_name(w_id, w_data)
+
+  try: panoptes_version = importlib.metadata.version('panoptes_aggregation')
+  except importlib.metadata.PackageNotFoundError: panoptes_version = None
+  ext = extraction_io.FORMATS[args.intermediate_format]
+  export_file = f'{args.exports}/{export_csv}'
+  config_export_file = f'{args.exports}/{workflow_defs["export"]}'
+
+  #As well as what to run, each task records what its outputs depend upon, so that it can be skipped if those have
+  #not changed since it last ran (see task_key): the files that it reads (other than the outputs of the tasks that it
+  #depends upon), any other data that affects it, and the code that it runs. It also lists the files that it writes.
+  tasks = {}
+  def add_task(step, func, func_args, deps, version = None, inputs = [], data = None, code = [], outputs = []):
+    version = f'{version[0]}.{version[1]}' if version else ''
+    name = f'{w_id} V{version} {step}' if version else f'{w_id} {step}'
+    tasks[name] = {'workflow': w_id, 'version': version, 'step': step, 'func': func, 'args': func_args, 'deps': [x for x in deps if x in tasks],
+                   'inputs': inputs, 'data': data, 'code': [func] + code, 'outputs': outputs}
+    return name
+
+  #Config and extraction run per-version: each version's extraction only needs its own config
+  if Phase.CONFIG.value in args.phase:
+    configs = [add_task('config', configure, (w_id, v), [], v,
+                        inputs = [config_export_file], data = panoptes_version, code = [panoptes_config, config_fixups],
+                        outputs = [f'{args.output_dir}/Reducer_config_workflow_{w_id}_V{v[0]}.{v[1]}_{ztype}_extractor.yaml',
+                                   f'{args.output_dir}/Task_labels_workflow_{w_id}_V{v[0]}.{v[1]}.yaml',
+                                   f'{args.output_dir}/Extractor_config_workflow_{w_id}_V{v[0]}.{v[1]}.yaml']) for v in versions]
+    add_task('config check', config_check_identity, (w_id, versions, ztype), configs, data = w_data)
+  if Phase.EXTRACT.value in args.phase:
+    #Only shard if extracting some version from the whole export would read classifications that it does not use
+    sources = {v: export_file for v in versions}
+    if os.path.isfile(export_file) and export_index.is_classification_export(export_file):
+      index = export_index.get_index(export_file)
+      if any(export_index.would_skip_rows(index, v) for v in versions):
+        sources = {v: shard_file(w_id, v) for v in versions}
+        add_task('shard', shard_export, (w_id, versions, export_file), [],
+                 inputs = [export_file], code = [shard_file, export_index], outputs = list(sources.values()))
+    extracts = [add_task('extract', panoptes_extract, (w_id, v, sources[v]), [f'{w_id} V{v[0]}.{v[1]} config', f'{w_id} shard'], v,
+                         inputs = [sources[v]] if sources[v] == export_file else [], data = panoptes_version,
+                         outputs = [f'{args.output_dir}/{ztype}_extractor_{w_id}_V{v[0]}_{v[1]}.csv']) for v in versions]
+    add_task('concatenate', concatenate_extractions, (w_id, versions, ztype, extraction_name), extracts + [f'{w_id} config check'],
+             outputs = [f'{extraction_name}.full.csv'])
+
+  #Because we are working on the output of panoptes_extract, we are no longer version-sensitive
+  if any(x.value in args.phase for x in (Phase.STRIP_PROCESSED, Phase.PICK_VOLUMES, Phase.CLEAN, Phase.POST_EXTRACT)):
+    add_task('prepare', prepare_extraction, (w_id, w_data, subjects_df), [f'{w_id} concatenate'],
+             inputs = ['tranches/empty_views.csv', 'tranches/views.csv', f'{args.output_dir}/subjects_metadata.csv'],
+             data = (w_data, workflow_defs[args.workflow_set]['first_volume'], workflow_defs[args.workflow_set]['final_volume'], args.intermediate_format, args.identity_sample, clean_stage.RULES.get(w_id)),
+             code = [strip_processed, pick_volumes, clean_extraction, strip_stage, pick_stage, clean_stage, extraction_io],
+             outputs = list(dict.fromkeys([f'{extraction_name}{x}' for x in (f'.stripped{ext}', f'.vols{ext}', f'.cleaned{ext}', '.csv', '.vols.csv')])))
 
   #Special case -- this could be version sensitive, as panoptes_config provides the reduction
   #configuration that it uses. However, config_check_identity confirms that all
   #reduction configs are the same, so in practice this is not version sensitive.
   if Phase.REDUCE.value in args.phase:
-    panoptes_reduce(w_id, versions, ztype, extraction_name + '.csv')
-
+    add_task('reduce', panoptes_reduce, (w_id, versions, ztype, extraction_name + '.csv'), [f'{w_id} prepare', f'{w_id} config check'],
+             data = panoptes_version, outputs = [f'{args.output_dir}/{ztype}_reducer_{w_id}.csv'])
+
+  return tasks
+
+def file_hash(fnam):
+  digest = hashlib.sha256()
+  with open(fnam, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''): digest.update(block)
+  return digest.hexdigest()
+
+#Hash, size and modification time of a file. If known (a previous result of this function for the same file) still
+#has the same size and modification time as the file then it is returned as-is, saving us from re-reading the file.
+def file_digest(fnam, known = None):
+  stat = os.stat(fnam)
+  if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns: return known
+  return {'sha256': file_hash(fnam), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+#The manifest records, for each task that has completed in args.output_dir, a key identifying everything that its outputs
+#depend upon, and digests of those outputs. Tasks whose key has not changed and whose outputs are intact need not be re-run.
+#It also records digests of the input files, so that large exports are only re-hashed when they change.
+def manifest_file():
+  return f'{args.output_dir}/manifest.json'
+
+def load_manifest():
+  try:
+    with open(manifest_file()) as f: manifest = json.load(f)
+    if manifest['version'] == MANIFEST_VERSION: return manifest
+  except FileNotFoundError: pass
+  return {'version': MANIFEST_VERSION, 'files': {}, 'tasks': {}}
+
+def save_manifest(manifest):
+  with open(manifest_file() + '.tmp', 'w') as f: json.dump(manifest, f, indent = 1)
+  os.replace(manifest_file() + '.tmp', manifest_file()) #So that an interrupted run cannot leave a partial manifest
+
+#Key for a task: a hash of its name, data and code, of the contents of its input files, and of the outputs of the
+#tasks that it depends upon (or the keys of those tasks, if they have no outputs). Editing workflow.yaml, a script or
+#an input file therefore changes the keys of the tasks that use them, and so of everything downstream of those tasks
+#whose inputs actually change as a result.
+def task_key(name, task, manifest):
+  for fnam in task['inputs']:
+    manifest['files'][fnam] = file_digest(fnam, manifest['files'].get(fnam))
+  return hashlib.sha256(json.dumps({
+    'task': name,
+    'data': task['data'],
+    'code': [inspect.getsource(x) for x in task['code']],
+    'inputs': {x: manifest['files'][x]['sha256'] for x in task['inputs']},
+    'deps': {x: {y: z['sha256'] for y, z in manifest['tasks'][x]['outputs'].items()} or manifest['tasks'][x]['key'] for x in task['deps']},
+  }, sort_keys = True, default = str).encode()).hexdigest()
+
+def up_to_date(name, key, manifest):
+  entry = manifest['tasks'].get(name)
+  if entry is None or entry['key'] != key: return False
+  for fnam, digest in entry['outputs'].items():
+    if not os.path.exists(fnam) or file_digest(fnam, digest)['sha256'] != digest['sha256']: return False
+  return True
+
+def run_task(func, func_args, outputs):
+  start = time.time()
+  func(*func_args)
+  return start, time.time(), {x: file_digest(x) for x in outputs}
+
+#Run tasks on a pool of args.jobs worker processes, starting each as soon as the tasks that it depends upon have completed.
+#When a task fails, the tasks that depend upon it are skipped, but everything else still runs.
+#If manifest is given, tasks that are up to date according to it are not run, and it is kept updated as tasks complete.
+#Returns the start and end times of the tasks that completed, and the names of those that did not.
+def run_tasks(tasks, manifest = None):
+  waiting = dict(tasks)
+  running = {}
+  keys = {}
+  times = {}
+  failed = []
+  with ProcessPoolExecutor(max_workers = args.jobs, mp_context = multiprocessing.get_context('fork')) as pool:
+    while waiting or running:
+      for name, task in list(waiting.items()):
+        if any(x in failed for x in task['deps']):
+          print(f'{name} skipped, as it depends upon a step that did not complete', file = sys.stderr)
+          failed.append(name)
+          del waiting[name]
+        elif all(x in times for x in task['deps']):
+          del waiting[name]
+          if manifest is not None:
+            keys[name] = task_key(name, task, manifest)
+            if up_to_date(name, keys[name], manifest):
+              print(f'{name} is up to date')
+              times[name] = (time.time(), time.time())
+              continue
+            manifest['tasks'].pop(name, None) #Its outputs are about to change
+            save_manifest(manifest)
+          if args.verbose: print(f'Starting {name}')
+          running[pool.submit(run_task, task['func'], task['args'], task['outputs'])] = name
+      if not running: continue #Everything left is being skipped, or was up to date
+      finished, _ = wait(running, return_when = FIRST_COMPLETED)
+      for future in finished:
+        name = running.pop(future)
+        try:
+          start, end, outputs = future.result()
+          times[name] = (start, end)
+          print(f'{name} completed in {end - start:.1f}s')
+          if manifest is not None:
+            manifest['tasks'][name] = {'key': keys[name], 'outputs': outputs}
+            save_manifest(manifest)
+        except Exception as e:
+          print(f'{name} failed: {e!r}', file = sys.stderr)
+          failed.append(name)
+  return times, failed
+
+#Report the chain of dependent tasks that took the longest time, and record the timing of every task in schedule.csv
+def report_schedule(tasks, times, wall_time):
+  path_time = {}
+  path_prev = {}
+  for name in sorted(times, key = lambda x: times[x][1]): #Every task ends after the tasks that it depends upon
+    prev = max(tasks[name]['deps'], key = lambda x: path_time[x], default = None)
+    path_prev[name] = prev
+    path_time[name] = times[name][1] - times[name][0] + (path_time[prev] if prev else 0)
+  critical = []
+  name = max(path_time, key = lambda x: path_time[x], default = None)
+  while name:
+    critical.insert(0, name)
+    name = path_prev[name]
+
+  if critical:
+    print(f'Critical path ({path_time[critical[-1]]:.1f}s of {wall_time:.1f}s wall time, {args.jobs} jobs):')
+    for name in critical:
+      print(f'  {times[name][1] - times[name][0]:8.1f}s  {name}')
+
+  start = min([x[0] for x in times.values()], default = 0)
+  pd.DataFrame([{
+    'task': name,
+    'workflow': task['workflow'],
+    'version': task['version'],
+    'step': task['step'],
+    'depends_on': '; '.join(task['deps']),
+    'start': times[name][0] - start if name in times else None,
+    'end': times[name][1] - start if name in times else None,
+    'seconds': times[name][1] - times[name][0] if name in times else None,
+    'critical': name in critical,
+  } for name, task in tasks.items()]).to_csv(f'{args.output_dir}/schedule.csv', index = False, float_format = '%.3f')
 
 def main():
-  exit_code = 0
-  procs = []
-
   parse_args()
+  extraction_io.check_format(args.intermediate_format)
   if set(args.phase) == set(DEFAULT_PHASES):
     try: os.mkdir(args.output_dir)
     except FileExistsError:
-      print(f"Output directory '{args.output_dir}' already exists.\nPlease delete it before running this script, or use --output_dir to output to a different directory.", file = sys.stderr)
-      sys.exit(1)
+      if not os.path.exists(manifest_file()):
+        print(f"Output directory '{args.output_dir}' already exists, but has no record of what produced its contents.\nPlease delete it before running this script, or use --output_dir to output to a different directory.", file = sys.stderr)
+        sys.exit(1)
+      print(f"Output directory '{args.output_dir}' already exists. Steps whose inputs have not changed since they last completed will not be re-run.")
   else:
     print('Running phases ' + ', '.join(filter(lambda x: x in args.phase, DEFAULT_PHASES))) #Comprehension to preserve phase order, rather than getting arbitrary CLI order
     print('Warning: Running a sub-set of all phases, likely on dirty data. Not recommended for a production run.', file = sys.stderr)
@@ -339,25 +615,24 @@ def main():
   with open(args.workflow_defs) as f:
     global workflow_defs
     workflow_defs = yaml.load(f, Loader = yaml.Loader)
+  clean_stage.load_rules(workflow_defs.get('cleaning', {})) #Before the worker processes fork, so that they all have the rules
 
   if Phase.SUBJECTS.value in args.phase:
     subjects_dfs = {}
     (subjects_dfs['subjects'], subjects_dfs['supplements'], subjects_dfs['duplicates']) = subjects.create_subjects_df(f'{args.exports}/{workflow_defs["subjects"]["export"]}', f'{args.output_dir}/subjects_metadata.csv', workflow_defs['subjects']['supplements'] if 'supplements' in workflow_defs['subjects'] else None)
 
+  #Read once here, rather than once per workflow
+  subjects_df = subjects.get_subjects_df(f'{args.output_dir}/subjects_metadata.csv') if Phase.PICK_VOLUMES.value in args.phase else None
+
+  tasks = {}
   for w_id, w_data in workflow_defs[args.workflow_set]['workflows'].items():
-    p_name = f'panoptes-wid-{w_id}-{w_data["name"].replace(" ", "_")}'
-    p = Process(target = panoptes, name = p_name, args = (w_id, w_data))
-    p.start()
-    if args.verbose:
-      print(f'Launched {p_name} as pid {p.pid}')
-    procs.append(p)
-
-  for p in procs:
-    p.join()
-    if p.exitcode != 0: exit_code = p.exitcode
-    print(f'{p.name} completed with exit code {p.exitcode}')
-  if exit_code != 0:
-    sys.exit(exit_code)
+    tasks.update(workflow_tasks(w_id, w_data, subjects_df))
+  start = time.time()
+  times, failed = run_tasks(tasks, load_manifest() if set(args.phase) == set(DEFAULT_PHASES) else None) #The manifest only makes sense when we run all of the steps
+  report_schedule(tasks, times, time.time() - start)
+  if failed:
+    print(f'{len(failed)} of {len(tasks)} steps did not complete: ' + ', '.join(failed), file = sys.stderr)
+    sys.exit(1)
 
   if Phase.SUBJECTS.value in args.phase:
     #Subject metadata checks
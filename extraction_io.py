@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#Reading and writing of the extraction files that extract.py passes from stage to stage
+#(.full -> .stripped -> .vols -> .cleaned).
+#The stages can keep these intermediates in a typed columnar format (Feather or Parquet), which
+#saves re-parsing and re-inferring a CSV file at every stage. panoptes_aggregation and aggregate.py
+#only understand CSV, so extract.py converts back to CSV at those boundaries.
+import os
+import numpy as np
+import pandas as pd
+
+#Columns in the output of "panoptes_aggregation extract" that we care about, and their types
+EXTRACTION_DTYPES = {
+  'classification_id': int,
+  'user_name': str,
+  'user_id': str,
+  'workflow_id': int,
+  'task': str,
+  'created_at': str,
+  'subject_id': int,
+  'extractor': str,
+  'data.text': str,
+  'data.gold_standard': str,
+  'data.value': str,
+  'data.aggregation_version': str
+}
+
+#Intermediate formats, with the filename extension that identifies each one
+FORMATS = {
+  'csv': '.csv',
+  'feather': '.feather',
+  'parquet': '.parquet',
+}
+COLUMNAR_EXTENSIONS = ('.feather', '.parquet')
+
+def extension(fnam):
+  ext = os.path.splitext(fnam)[1]
+  return ext if ext in COLUMNAR_EXTENSIONS else '.csv'
+
+def check_format(fmt):
+  if fmt == 'csv': return
+  try: import pyarrow
+  except ImportError:
+    raise Exception(f'Intermediate format "{fmt}" requires pyarrow, which is not installed (try "pip install pyarrow")')
+
+#dtype, converters and csv_args are as for pd.read_csv. For columnar files the stored types are used,
+#then adjusted to match dtype and converters so that callers see the same frame whatever the format.
+def read_extraction(fnam, dtype, converters = None, **csv_args):
+  ext = extension(fnam)
+  if ext == '.csv':
+    return pd.read_csv(fnam, dtype = dtype, converters = converters, **csv_args)
+  df = pd.read_feather(fnam) if ext == '.feather' else pd.read_parquet(fnam)
+  df = df.astype({k: v for k, v in dtype.items() if k in df.columns})
+  if converters:
+    for column, converter in converters.items():
+      df[column] = df[column].map(converter)
+  return df
+
+#csv_args are only used when writing CSV
+def write_extraction(df, fnam, **csv_args):
+  ext = extension(fnam)
+  if ext == '.csv':
+    df.to_csv(fnam, index = False, **csv_args)
+    return
+  #Columns that pandas could not type when reading the CSV can hold a mix of numbers and strings, which
+  #Arrow will not store. They are all strings as far as the CSV output is concerned.
+  df = df.reset_index(drop = True)
+  mixed = [x for x in df.columns if df[x].dtype == object]
+  df[mixed] = df[mixed].astype(str)
+  if ext == '.feather': df.to_feather(fnam)
+  else: df.to_parquet(fnam, index = False)
+
+#Apply func to each distinct value in values (a Series or other list-like), calling it once per distinct value,
+#and return the results as a Series with the same index as values. Missing values (None or NaN) all count as one
+#value, which func is called on too.
+#pd.factorize's use_na_sentinel needs pandas 1.5, so missing values are given the default code of -1 here, which
+#picks out the extra slot at the end of the results.
+def map_distinct(values, func):
+  values = pd.Series(values, dtype = object)
+  codes, uniques = pd.factorize(values)
+  results = np.empty(len(uniques) + 1, dtype = object)
+  for i, x in enumerate(uniques): results[i] = func(x)
+  missing = codes == -1
+  if missing.any(): results[-1] = func(values[missing].iloc[0])
+  return pd.Series(results[codes], index = values.index, dtype = object)
@@ -5,7 +5,7 @@ import csv
 import sys
 import yaml
 import argparse
-from datetime import datetime
+import dates
 
 LEGAL_FRACTIONS = [
   '08',
@@ -53,8 +53,7 @@ def normalize(row):
       if field == 'date of entry' or field == 'date of discharge': #convert dates to expected format
         if row[field] != '':
           try:
-            tmp = datetime.strptime(row[field], '%b %d %Y')
-            normalized_row[field] = tmp.strftime('%d-%m-%Y')
+            normalized_row[field] = dates.format_cleaned(dates.parse_resolved(row[field]))
           except ValueError:
             sys.stderr.write(f'Error: bad date format "{row[field]}" in "{field}" at line {row_count + 1} of {args.input}. Should be like "Apr 01 1800".\n')
             normalized_row[field] = row[field]
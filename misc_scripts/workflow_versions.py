@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 #Example incantation: ./misc_scripts/workflow_versions.py ./exports/[[:digit:]]*
 
-import csv
+import os
 import sys
-from collections import Counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import export_index
 
 for export_fnam in sys.argv[1:]:
   print(export_fnam)
-  with open(export_fnam, 'r') as export_file:
-    reader = csv.DictReader(export_file)
-    counted_versions = Counter([x['workflow_version'] for x in reader])
-    print('\n'.join([f'{k:>10}: {v:>8} instances' for k, v in counted_versions.items()]))
+  counted_versions = export_index.version_counts(export_index.get_index(export_fnam))
+  print('\n'.join([f'{k:>10}: {v:>8} instances' for k, v in counted_versions.items()]))
@@ -3,53 +3,84 @@
 import pandas as pd
 import argparse
 import os
+import hashlib
+import extraction_io
 
-parser = argparse.ArgumentParser(description = 'This script removed previously-processed data from the extractions file, saving us from regenerating it.')
-parser.add_argument('extraction', nargs = '+', help = 'Extractions file as produced by "panoptes_aggregation extract"')
-parser.add_argument('--tranche', '-t', help = 'File containing record of views for each row in each subject')
-parser.add_argument('--suffix', '-s', default = '.stripped.csv', help = 'Suffix to put on output extractions file: the output file will be named as the input file, but with this as its name extension. Default: ".stripped.csv".')
-parser.add_argument('--no_sort', action = 'store_true', help = 'By default, this script sorts the output extractions file by classification_id and task number. Set this option to output the extractions file in the same order as the input file. If -t specifies no previously complete rows and --no_sort is set, then the input and output files are identical.')
-args = parser.parse_args()
-
-tranche_df = pd.read_csv(args.tranche, index_col = ['subject_id', 'task'],
-                         usecols = ['subject_id', 'task', 'complete'],
-                         dtype = {'subject_id': int, 'task': int, 'complete': bool})
-
-for extraction in args.extraction:
-  #Read in the extractions and drop all classifications relating to completed tasks
-  extraction_df = pd.read_csv(extraction, na_filter = False, index_col = False, dtype = {
-      'classification_id': int,
-      'user_name': str,
-      'user_id': str,
-      'workflow_id': int,
-      'created_at': str,
-      'subject_id': int,
-      'extractor': str,
-      'data.text': str,
-      'data.gold_standard': str,
-      'data.value': str,
-      'data.aggregation_version': str
-    },
-    converters = {'task': lambda x: str(x)[1:]} ) #Here the task has leading T, but in tranche_df it does not
-  extraction_df['task'] = extraction_df['task'].astype('int32')
+def read_tranche(tranche):
+  return pd.read_csv(tranche, index_col = ['subject_id', 'task'],
+                     usecols = ['subject_id', 'task', 'complete'],
+                     dtype = {'subject_id': int, 'task': int, 'complete': bool})
+
+#Drop all classifications relating to completed tasks
+#extraction_df is as read by extraction_io.read_extraction, tranche_df as read by read_tranche
+def strip_processed(extraction_df, tranche_df, sort = True):
   extraction_cols = list(extraction_df.columns)
+  extraction_df = extraction_df.assign(task = extraction_df['task'].str[1:].astype('int32')) #Here the task has leading T, but in tranche_df it does not
   extraction_df = extraction_df.set_index(['subject_id', 'task'])
   extraction_df = extraction_df.join(tranche_df['complete'], how = 'left')
-  full_len = len(extraction_df)
   extraction_df = extraction_df[extraction_df['complete'] != True] #odd logic to handle NaN correctly
-  stripped_len = len(extraction_df)
 
   #Restore to original format.
   #If no classifications were complete in previous tranche(s) and we do not sort (or if the
   #sorting happens to be a nop, which it seems that it is when we have not concatenated extractions)
   #then this leaves us with an identify transform.
   extraction_df = extraction_df.reset_index()
-  if not args.no_sort:
+  if sort:
     extraction_df = extraction_df.sort_values(by = ['classification_id', 'task']) #TODO: Would it make more sense to sort by subject_id and task?
   extraction_df = extraction_df.reindex(columns = extraction_cols)
 
   extraction_df['task'] = 'T' + extraction_df['task'].astype(str)
-  outname = extraction.split(".", 1)[0] + args.suffix
-  extraction_df.to_csv(outname, float_format = '%.99g', index = False)
+  return extraction_df
+
+#File-like object that hashes what is written to it, rather than storing it
+class HashWriter:
+  def __init__(self):
+    self.digest = hashlib.sha256()
+  def write(self, text):
+    self.digest.update(text.encode('utf-8'))
+
+#Self-test: with no completed rows in tranche_df and no sorting, strip_processed should give back exactly what it was
+#given, so writing its output should reproduce the file that extraction_df was read from (fnam, a CSV file).
+#Rather than write that output and compare it with fnam, compare a hash of the bytes that would be written with a hash
+#of fnam. With sample N, only every Nth row is checked. This needs each row of fnam to be on a line of its own; if
+#not, all rows are checked.
+#Returns the number of rows checked, or raises an Exception if the output would differ from fnam.
+def check_identity(fnam, extraction_df, tranche_df, sample = 1):
+  expected = hashlib.sha256()
+  with open(fnam, 'rb') as f:
+    lines = 0
+    for line in f:
+      if lines == 0 or (lines - 1) % sample == 0: expected.update(line) #Header, then every sample'th row
+      lines += 1
+  if sample > 1 and lines != len(extraction_df) + 1:
+    print(f'{fnam} has rows that span more than one line, so checking all rows rather than a sample')
+    return check_identity(fnam, extraction_df, tranche_df)
+
+  if sample > 1: extraction_df = extraction_df.iloc[::sample]
+  actual = HashWriter()
+  strip_processed(extraction_df, tranche_df, sort = False).to_csv(actual, index = False, float_format = '%.99g')
+  if actual.digest.digest() != expected.digest():
+    raise Exception(f'strip_processed is not an identity transform on {fnam}')
+  return len(extraction_df)
+
+def main():
+  parser = argparse.ArgumentParser(description = 'This script removed previously-processed data from the extractions file, saving us from regenerating it.')
+  parser.add_argument('extraction', nargs = '+', help = 'Extractions file as produced by "panoptes_aggregation extract"')
+  parser.add_argument('--tranche', '-t', help = 'File containing record of views for each row in each subject')
+  parser.add_argument('--suffix', '-s', default = '.stripped.csv', help = 'Suffix to put on output extractions file: the output file will be named as the input file, but with this as its name extension. Default: ".stripped.csv". A suffix ending ".feather" or ".parquet" writes that format instead of CSV (requires pyarrow). Input files in these formats are recognised by their extension.')
+  parser.add_argument('--no_sort', action = 'store_true', help = 'By default, this script sorts the output extractions file by classification_id and task number. Set this option to output the extractions file in the same order as the input file. If -t specifies no previously complete rows and --no_sort is set, then the input and output files are identical.')
+  args = parser.parse_args()
+
+  tranche_df = read_tranche(args.tranche)
+
+  for extraction in args.extraction:
+    extraction_df = extraction_io.read_extraction(extraction, dtype = extraction_io.EXTRACTION_DTYPES, na_filter = False, index_col = False)
+    full_len = len(extraction_df)
+    extraction_df = strip_processed(extraction_df, tranche_df, not args.no_sort)
+    outname = extraction.split(".", 1)[0] + args.suffix
+    extraction_io.write_extraction(extraction_df, outname, float_format = '%.99g')
+
+    print(f"Removed {full_len - len(extraction_df)} rows from {extraction}. Output ({'unsorted' if args.no_sort else 'sorted'}) in {outname}.")
 
-  print(f"Removed {full_len - stripped_len} rows from {extraction}. Output ({'unsorted' if args.no_sort else 'sorted'}) in {outname}.")
+if __name__ == '__main__':
+  main()
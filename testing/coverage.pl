@@ -1,6 +1,8 @@
 #!/usr/bin/env perl
 use strict;
 use warnings;
+use JSON::PP;
+use File::Temp;
 $, = "\n";
 $\ = "\n";
 
@@ -12,13 +14,12 @@ my %flowids = (
                             'Unresolvable (both sides)',
                             'Unresolvable (navy side)',
                             'Unresolvable (merchant side)'],
-  string_resolver => ['port sailed out of in volume 1 (later)',
-                      'port sailed out of in volume 1 (first)',
-                      'Did not pass threshold',
-                      'Later autoresolve',
-                      'First autoresolve',
+  string_resolver => ['Did not pass threshold',
+                      'Autoresolved',
                       'Unambiguous'],
+  main => ['port sailed out of in volume 1'],
   date_resolver => ['Surprising input',
+                    'Zero-field (or bad field count)',
                     'Unparseable',
                     'Autoresolved',
                     'Unanimous',
@@ -41,20 +42,17 @@ while(my ($prefix, $postfixen) = each %flowids) {
 }
 
 my @unknown = ();
-my @identifiers = keys %unseen;
-my @output = grep(/^FR: /, `./aggregate.py -f @ARGV`);
-foreach (@output) {
-  chomp;
-  $_ = substr($_, 4);
-}
-LINE: foreach my $line (@output) {
-  foreach my $identifier (@identifiers) {
-    if($line eq $identifier) {
-      delete $unseen{$identifier};
-      next LINE;
-    }
-  }
-  push @unknown, $line;
+my $counts_file = File::Temp->new(SUFFIX => '.json');
+`./aggregate.py --flow_counts @{[$counts_file->filename]} @ARGV`;
+die "aggregate.py failed\n" if $?;
+my $counts = do {
+  local $/;
+  open(my $fh, '<', $counts_file->filename) or die "Cannot read flow counts: $!\n";
+  decode_json(<$fh>);
+};
+foreach my $identifier (keys %$counts) {
+  if(exists $unseen{$identifier}) { delete $unseen{$identifier}; }
+  else { push @unknown, $identifier; }
 }
 
 my $errcode = 0;
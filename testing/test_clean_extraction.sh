@@ -0,0 +1,122 @@
+#!/bin/bash
+#Tests for clean_extraction.py's handling of files: however the files are split into chunks and shared out
+#between processes, the output should be the same as cleaning each file in one go.
+#Usage: test_clean_extraction.sh
+
+PASSCOUNT=0
+FAILCOUNT=0
+
+function result {
+  if [[ $1 -eq 0 ]]; then
+    echo "PASS  $2"
+    ((PASSCOUNT++))
+  else
+    echo "FAIL  $2"
+    ((FAILCOUNT++))
+  fi
+}
+
+BASEDIR="`dirname $0`"
+mkdir "$BASEDIR"/output/clean_extraction || { echo "`realpath ${BASEDIR}`/output/clean_extraction already exists: please remove and retry" 2>&1; exit 1; }
+cd $BASEDIR
+FIXTURES=qtest_pen/extracttest
+OUTDIR=output/clean_extraction
+CLEAN="../clean_extraction.py --workflow_defs ../workflow.yaml"
+
+#Chunked and parallel cleaning give the same output as cleaning in one go
+for w in 18612 18613 18619 18621; do cp $FIXTURES/test$w.csv $OUTDIR/; done
+PAIRS="$OUTDIR/test18612.csv 18612 $OUTDIR/test18613.csv 18613 $OUTDIR/test18619.csv 18619 $OUTDIR/test18621.csv 18621"
+$CLEAN $PAIRS > $OUTDIR/whole_stdout
+mkdir $OUTDIR/whole && cp $OUTDIR/*.cleaned.csv $OUTDIR/whole/
+for opts in "--chunksize 7" "--jobs 2" "--jobs 2 --chunksize 7"; do
+  rm $OUTDIR/*.cleaned.csv
+  $CLEAN $PAIRS $opts > $OUTDIR/chunked_stdout
+  same=0
+  diff -q $OUTDIR/whole_stdout $OUTDIR/chunked_stdout > /dev/null || same=1
+  for f in $OUTDIR/whole/*; do diff -q $f $OUTDIR/`basename $f` > /dev/null || same=1; done
+  result $same "fixtures with $opts"
+done
+
+#A file with a header but no rows gives an output file with just the header
+head -1 $FIXTURES/testtranche_input.csv > $OUTDIR/empty.csv
+for opts in "" "--chunksize 7" "--jobs 2 --chunksize 7"; do
+  rm -f $OUTDIR/empty.cleaned.csv
+  $CLEAN $OUTDIR/empty.csv 18613 $opts > /dev/null
+  diff -q $OUTDIR/empty.csv $OUTDIR/empty.cleaned.csv > /dev/null
+  result $? "empty file with options '$opts'"
+done
+
+#The same, where the CSV reader gives no chunks at all for the empty file (as some versions of pandas do)
+rm -f $OUTDIR/empty.cleaned.csv
+PYTHONPATH=.. python3 - $OUTDIR/empty.csv <<'EOF'
+import sys
+import extraction_io
+import clean_extraction
+
+read_extraction = extraction_io.read_extraction
+def no_chunks(fnam, dtype, converters = None, **csv_args):
+  if 'chunksize' in csv_args: return iter([])
+  return read_extraction(fnam, dtype, converters, **csv_args)
+extraction_io.read_extraction = no_chunks
+
+clean_extraction.load_rules(clean_extraction.read_rules('../workflow.yaml'))
+outfile = sys.argv[1].replace('.csv', '.cleaned.csv')
+clean_extraction.clean_files([(sys.argv[1], '18613')], chunksize = 7)
+with open(sys.argv[1]) as f: expected = f.read()
+try:
+  with open(outfile) as f: actual = f.read()
+except FileNotFoundError: actual = None
+sys.exit(0 if actual == expected else 1)
+EOF
+result $? "empty file when the reader gives no chunks"
+
+#Merging runs of words rules (see compile_rules) changes nothing: each workflow's rules give the same results with
+#and without merging, on the fixtures and on generated text made from the words that the rules replace
+PYTHONPATH=.. python3 - ../workflow.yaml $FIXTURES/test*.csv <<'EOF'
+import sys
+import itertools
+import yaml
+import pandas as pd
+import clean_extraction
+
+def outcome(f, x):
+  try: return f(x)
+  except Exception as e: return type(e)
+
+def words(rules):
+  for rule in clean_extraction.flatten_rules(rules):
+    if isinstance(rule, dict) and 'words' in rule: yield from [x for pair in rule['words'].items() for x in pair]
+    if isinstance(rule, dict) and 'rules' in rule: yield from words(rule['rules'])
+
+with open(sys.argv[1]) as f: defs = yaml.load(f, Loader = yaml.Loader)
+values = set()
+for fnam in sys.argv[2:]:
+  df = pd.read_csv(fnam, dtype = str, keep_default_na = False)
+  if 'data.text' in df.columns: values.update(df['data.text'])
+
+failed = 0
+count = 0
+for w_id, rules in defs['cleaning'].items():
+  merged = clean_extraction.compile_rules(rules)
+  unmerged = clean_extraction.compile_rules(rules, merge = False)
+  vocabulary = sorted(set(words(rules))) + ['new', 'york', 'Mc', 'a.']
+  generated = [' '.join(x) for n in range(1, 4) for x in itertools.permutations(vocabulary, n)]
+  for x in sorted(values) + generated + [x.lower() for x in generated]:
+    count += 1
+    if outcome(merged, x) != outcome(unmerged, x):
+      if failed < 10: print(f'  {w_id} {x!r}: {outcome(merged, x)!r} vs {outcome(unmerged, x)!r}', file = sys.stderr)
+      failed += 1
+print(f'{failed} of {count} values differ')
+
+#The words rules in NORMALISE_CASE do merge, into a single step
+rules = defs['definitions']['NORMALISE_CASE'][0]['rules']
+merged = len(clean_extraction.compile_rules(rules).steps)
+unmerged = len(clean_extraction.compile_rules(rules, merge = False).steps)
+print(f'NORMALISE_CASE: {merged} steps merged, {unmerged} unmerged')
+if merged != unmerged - len([x for x in rules if isinstance(x, dict) and 'words' in x]) + 1: failed += 1
+sys.exit(1 if failed else 0)
+EOF
+result $? "merged cleaning rules give the same results as unmerged"
+
+echo "Passed $PASSCOUNT of $((PASSCOUNT + FAILCOUNT)) tests"
+exit $FAILCOUNT
@@ -0,0 +1,137 @@
+#!/bin/bash
+#Tests for the shared date parser in dates.py.
+#dates.parse_date must give exactly the same results as dateutil.parser.parse(text, dayfirst = True), and
+#dates.parse_resolved the same as datetime.strptime(text, '%b %d %Y'), as they replace those calls in
+#clean_extraction.py, aggregate.py and mimsify.py. This checks that exhaustively over the shapes that
+#the fast path handles and on the date fixtures, timing both while it is at it.
+#Usage: test_dates.sh [-n ROWS]
+#ROWS is the number of dates to time the parsers on (default: 200000), made by repeating the fixture values.
+
+PASSCOUNT=0
+FAILCOUNT=0
+ROWS=200000
+
+function result {
+  if [[ $1 -eq 0 ]]; then
+    echo "PASS  $2"
+    ((PASSCOUNT++))
+  else
+    echo "FAIL  $2"
+    ((FAILCOUNT++))
+  fi
+}
+
+while getopts "n:" x; do
+  case "$x" in
+    n) ROWS="$OPTARG";;
+    *) echo "Bad args"; exit 1;;
+  esac
+done
+shift $((OPTIND-1))
+
+BASEDIR="`dirname $0`"
+cd $BASEDIR
+FIXTURES=qtest_pen/extracttest
+
+#clean_extraction.py's own golden test for dates (test18612) is in qtest_pen/qtest.sh.
+#Note that it uses two-digit years, which dateutil reads relative to the current date.
+
+#Equivalence: the fast paths agree with dateutil and strptime on every day-month-year shape that they handle
+PYTHONPATH=.. python3 - <<'EOF'
+import sys
+import datetime
+import dateutil.parser
+import dates
+
+def outcome(f, x):
+  try: return f(x)
+  except Exception as e: return type(e)
+
+fields = [str(i) for i in range(100)] + [f'0{i}' for i in range(10)]
+failed = 0
+count = 0
+for year in ['0001', '0099', '0100', '1000', '1799', '1800', '1826', '1899', '1900', '2026', '9999']:
+  for sep in '-/.=':
+    for day in fields:
+      for month in fields:
+        x = f'{day}{sep}{month}{sep}{year}'
+        if not dates.DAY_MONTH_YEAR.fullmatch(x): continue
+        count += 1
+        expected = outcome(lambda y: dateutil.parser.parse(y.replace('=', '-'), dayfirst = True), x)
+        if outcome(dates.parse_date, x) != expected:
+          if failed < 10: print(f'  {x!r}: {outcome(dates.parse_date, x)!r} vs {expected!r}', file = sys.stderr)
+          failed += 1
+  for month in ['Jan', 'Feb', 'Apr', 'Sep', 'Dec', 'jan', 'APR', 'Foo']:
+    for day in fields:
+      x = f'{month} {day} {year}'
+      count += 1
+      expected = outcome(lambda y: datetime.datetime.strptime(y, dates.RESOLVED_FORMAT), x)
+      if outcome(dates.parse_resolved, x) != expected:
+        if failed < 10: print(f'  {x!r}: {outcome(dates.parse_resolved, x)!r} vs {expected!r}', file = sys.stderr)
+        failed += 1
+print(f'{failed} of {count} generated dates differ')
+sys.exit(1 if failed else 0)
+EOF
+result $? "fast paths match dateutil and strptime on generated dates"
+
+#Equivalence and benchmark: the same on the fixtures -- transcribed dates and the cleaned dates that aggregate.py parses,
+#and the resolved dates that mimsify.py reads
+PYTHONPATH=.. python3 - $FIXTURES/test18612.csv $FIXTURES/test18612.golden.csv input/mimsy/dates.csv $ROWS <<'EOF'
+import sys
+import time
+import datetime
+import dateutil.parser
+import pandas as pd
+import dates
+
+def outcome(f, x):
+  try: return f(x)
+  except Exception as e: return type(e)
+
+def read(fnam, col):
+  return pd.read_csv(fnam, usecols = [col], dtype = str, keep_default_na = False, skip_blank_lines = False)[col]
+
+transcribed = pd.concat([read(sys.argv[1], 'data.text'), read(sys.argv[2], 'data.text')]).str.strip()
+resolved = pd.concat([read(sys.argv[3], x) for x in ['date of entry', 'date of discharge']])
+resolved = resolved[resolved != '']
+rows = int(sys.argv[4])
+
+failed = 0
+for name, values, fast, slow in (
+  ('transcribed', transcribed, dates.parse_date, lambda x: dateutil.parser.parse(x.replace('=', '-'), dayfirst = True)),
+  ('resolved', resolved, dates.parse_resolved, lambda x: datetime.datetime.strptime(x, dates.RESOLVED_FORMAT)),
+):
+  mismatches = [x for x in values if outcome(fast, x) != outcome(slow, x)]
+  if mismatches:
+    print(f'{len(mismatches)} of {len(values)} {name} values differ, for example:', file = sys.stderr)
+    for x in mismatches[:10]: print(f'  {x!r}: {outcome(fast, x)!r} vs {outcome(slow, x)!r}', file = sys.stderr)
+    failed = 1
+
+  #Time on good dates (the resolved fixture is mostly deliberately bad dates, so use the transcribed dates in the
+  #form that aggregate.py writes them), repeated to make the requested number of rows. Real data repeats dates a
+  #lot, so this times the parsers with their caches, as the scripts use them.
+  values = [x for x in dates.parse_dates(transcribed) if x]
+  if name == 'transcribed': values = [dates.format_cleaned(x) for x in values]
+  else: values = [dates.format_resolved(x) for x in values]
+  values = values * (rows // len(values) + 1)
+  values = values[:rows]
+  start = time.perf_counter()
+  for x in values: outcome(slow, x)
+  slow_time = time.perf_counter() - start
+  fast.cache_clear()
+  start = time.perf_counter()
+  for x in values: outcome(fast, x)
+  fast_time = time.perf_counter() - start
+  print(f'{name}: {rows} values, original {slow_time:.3f}s, dates.py {fast_time:.3f}s ({slow_time / fast_time:.1f}x)')
+
+expected = [outcome(dates.parse_date, x) for x in transcribed]
+expected = [x if isinstance(x, datetime.datetime) else None for x in expected]
+if list(dates.parse_dates(transcribed)) != expected:
+  print('parse_dates does not match parse_date', file = sys.stderr)
+  failed = 1
+sys.exit(failed)
+EOF
+result $? "fast paths match dateutil and strptime on fixtures"
+
+echo "Passed $PASSCOUNT of $((PASSCOUNT + FAILCOUNT)) tests"
+exit $FAILCOUNT
@@ -0,0 +1,67 @@
+#!/bin/bash
+#Tests for export_index.export_info, which gathers the tranche information about each export for extract.py.
+#Its results must match those from simply reading the whole file, whatever the block size, including when
+#a block boundary falls part way through a multi-byte character.
+#Usage: test_export_info.sh
+
+PASSCOUNT=0
+FAILCOUNT=0
+
+function result {
+  if [[ $1 -eq 0 ]]; then
+    echo "PASS  $2"
+    ((PASSCOUNT++))
+  else
+    echo "FAIL  $2"
+    ((FAILCOUNT++))
+  fi
+}
+
+BASEDIR="`dirname $0`"
+mkdir "$BASEDIR"/output/export_info || { echo "`realpath ${BASEDIR}`/output/export_info already exists: please remove and retry" 2>&1; exit 1; }
+cd $BASEDIR
+OUTDIR=output/export_info
+
+#Exports with non-ASCII text (as in real transcriptions), with and without a final newline
+PYTHONPATH=.. python3 - $OUTDIR <<'EOF'
+import sys
+import hashlib
+import export_index
+
+TAIL_LINES = 3
+rows = ['classification_id,annotations'] + [f'{i},"Paid £{i} to Mr Müller — “Ship’s” œuvre; ✓"' for i in range(1, 40)]
+exports = {
+  'newline.csv': '\n'.join(rows) + '\n',
+  'no_newline.csv': '\n'.join(rows),
+  'short.csv': '\n'.join(rows[:2]) + '\n',
+}
+
+failed = 0
+checked = 0
+for name, text in exports.items():
+  fnam = f'{sys.argv[1]}/{name}'
+  with open(fnam, 'w', encoding = 'utf-8') as f: f.write(text)
+  data = text.encode('utf-8')
+  lines = text.splitlines(keepends = True)
+  expected = {
+    'lines': len(lines),
+    'bytes': len(data),
+    'final_line_offset': len(data) - len(lines[-1].encode('utf-8')),
+    'sha256': hashlib.sha256(data).hexdigest(),
+    'tail': lines[-TAIL_LINES:],
+  }
+  for block_size in range(1, 200):
+    export_index.BLOCK_SIZE = block_size
+    try: actual = export_index.export_info(fnam, TAIL_LINES)
+    except Exception as e: actual = repr(e)
+    checked += 1
+    if actual != expected:
+      if failed < 10: print(f'  {name} with block size {block_size}: {actual!r}', file = sys.stderr)
+      failed += 1
+print(f'{failed} of {checked} differ')
+sys.exit(1 if failed else 0)
+EOF
+result $? "export_info on non-ASCII exports, at every block size"
+
+echo "Passed $PASSCOUNT of $((PASSCOUNT + FAILCOUNT)) tests"
+exit $FAILCOUNT
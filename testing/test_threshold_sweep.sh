@@ -0,0 +1,123 @@
+#!/bin/bash
+#Tests for aggregate.py --threshold_sweep: the counts that it reports for each combination of thresholds must be
+#those of the joined.csv that a normal run at the same thresholds writes.
+#The qtest reducer files have no extractor or subjects files to go with them, so this makes some: three
+#classifications of each page, one of which stops short of the last three rows on every fourth page, and
+#subjects alternating between volumes 1 and 2. Dates that are not day-month-year numbers are left out, as
+#aggregate.py expects extract.py to have cleaned them (see unstring_date in clean_extraction.py).
+#Only the few pages that every workflow has can be complete, so without --unfinished most rows are removed.
+#Usage: test_threshold_sweep.sh
+
+PASSCOUNT=0
+FAILCOUNT=0
+
+function result {
+  if [[ $1 -eq 0 ]]; then
+    echo "PASS  $2"
+    ((PASSCOUNT++))
+  else
+    echo "FAIL  $2"
+    ((FAILCOUNT++))
+  fi
+}
+
+BASEDIR="`dirname $0`"
+mkdir "$BASEDIR"/output/threshold_sweep || { echo "`realpath ${BASEDIR}`/output/threshold_sweep already exists: please remove and retry" 2>&1; exit 1; }
+cd $BASEDIR
+OUTDIR=output/threshold_sweep
+
+python3 - qtest_pen/testdata/baseline $OUTDIR/inputs <<'EOF' || { echo "Failed to make the inputs" 2>&1; exit 1; }
+import os
+import sys
+import glob
+import shutil
+import ast
+import re
+import pandas as pd
+
+DATE_WORKFLOWS = ['18612', '18623'] #date of entry and date of discharge
+
+def numeric_dates(aligned_text):
+  if aligned_text == '': return True
+  candidates = ast.literal_eval(aligned_text)
+  return len(candidates) != 1 or all([re.fullmatch(r'\d+[-/\.]\d+[-/\.]\d+', x) for x in candidates[0]])
+
+src, dst = sys.argv[1], sys.argv[2]
+os.mkdir(dst)
+for fnam in glob.glob(f'{src}/*.yaml'): shutil.copy(fnam, dst)
+reducers = {fnam: pd.read_csv(fnam, dtype = str, keep_default_na = False) for fnam in sorted(glob.glob(f'{src}/*_reducer_*.csv'))}
+subjects = set.union(*[set(df['subject_id']) for df in reducers.values()])
+
+classification_id = 1000
+for fnam, df in reducers.items():
+  if any([fnam.endswith(f'_{x}.csv') for x in DATE_WORKFLOWS]): df = df[df['data.aligned_text'].map(numeric_dates)]
+  df.to_csv(f'{dst}/{os.path.basename(fnam)}', index = False)
+  if not os.path.basename(fnam).startswith('text_reducer_'): continue
+  wid = fnam[:-len('.csv')].split('_')[-1]
+  rows = []
+  for subject_id, tasks in df.groupby('subject_id', sort = False)['task']:
+    for i in range(3):
+      classification_id += 1
+      short = i == 0 and int(subject_id) % 4 == 0
+      for task in (list(tasks)[:-3] if short else tasks): rows.append((classification_id, i + 1, wid, task, subject_id))
+  extractor = pd.DataFrame(rows, columns = ['classification_id', 'user_id', 'workflow_id', 'task', 'subject_id'])
+  extractor['data.text'] = 'x'
+  extractor.to_csv(f'{dst}/text_extractor_{wid}.csv', index = False)
+  extractor.to_csv(f'{dst}/text_extractor_{wid}.vols.csv', index = False)
+
+subjects = sorted(subjects, key = int)
+pd.DataFrame({
+  'subject_id': subjects,
+  'location': [f'https://example.com/{x}.jpg' for x in subjects],
+  'volume': [1 + i % 2 for i in range(len(subjects))],
+  'page': range(1, len(subjects) + 1),
+}).to_csv(f'{dst}/subjects_metadata.csv', index = False)
+EOF
+
+#Compare a sweep with a normal run at each of its combinations of thresholds
+#Usage: sweep_test NAME [ARGS...]
+function sweep_test {
+  local name=$1
+  shift
+  local args=(phase1 -S -v -1 --workflow_defs ../workflow.yaml -r $OUTDIR/inputs --no_cache "$@")
+  ../aggregate.py "${args[@]}" --output_dir $OUTDIR/$name.sweep --threshold_sweep 0.5 0.8 --dropdown_sweep 0.5 0.66 > /dev/null || { result 1 "$name: sweep ran"; return; }
+  for t in 0.5 0.8; do
+    for d in 0.5 0.66; do
+      ../aggregate.py "${args[@]}" --output_dir $OUTDIR/$name.$t.$d -t $t -d $d > /dev/null || { result 1 "$name: run at $t $d"; continue; }
+    done
+  done
+  PYTHONPATH=.. python3 - $OUTDIR $name <<'EOF'
+import sys
+import pandas as pd
+
+outdir, name = sys.argv[1], sys.argv[2]
+sweep = pd.read_csv(f'{outdir}/{name}.sweep/threshold_sweep.csv')
+failed = 0
+for _, line in sweep.iterrows():
+  joined = pd.read_csv(f'{outdir}/{name}.{line["text_threshold"]}.{line["dropdown_threshold"]}/joined.csv', dtype = str, keep_default_na = False)
+  problems = joined['Problems']
+  unresolved = problems.str.extract(r'(\d+) unresolved fields$', expand = False)
+  expected = {
+    'rows': len(joined.index),
+    'unresolved_rows': unresolved.notnull().sum(),
+    'blank_only_rows': problems.eq('Blank(s)').sum(),
+    'complete_rows': problems.eq('').sum(),
+    'unresolved_cells': unresolved.dropna().astype(int).sum(),
+    'autoresolved_cells': joined['Autoresolved'][joined['Autoresolved'] != ''].str.split('; ').str.len().sum(),
+  }
+  print(f'  {line["text_threshold"]} {line["dropdown_threshold"]}: {expected}')
+  for k, v in expected.items():
+    if line[k] != v:
+      print(f'  {k} is {line[k]} in the sweep, {v} in joined.csv', file = sys.stderr)
+      failed = 1
+sys.exit(failed)
+EOF
+  result $? "$name: sweep counts match joined.csv"
+}
+
+sweep_test unfinished -u
+sweep_test finished
+sweep_test no_transcriptionisms --no_transcriptionisms
+
+echo "Passed $PASSCOUNT of $((PASSCOUNT + FAILCOUNT)) tests"
+exit $FAILCOUNT
@@ -0,0 +1,78 @@
+#!/bin/bash
+#Tests for the "years at sea" cleaner in clean_extraction.py.
+#clean_18619_bulk must give exactly the same results as mapping clean_18619 over the values, as it is what
+#clean_extraction.py actually uses for this workflow. This checks that against the test18619 fixtures, and on a
+#full-size extraction, timing both while it is at it.
+#Usage: test_years_at_sea.sh [-n ROWS] [EXTRACTION]
+#EXTRACTION is a "years at sea" extraction file, such as extraction/text_extractor_18619.vols.csv. If it is not
+#given, the benchmark uses the fixture values repeated to make ROWS rows (default: 200000).
+
+PASSCOUNT=0
+FAILCOUNT=0
+ROWS=200000
+
+function result {
+  if [[ $1 -eq 0 ]]; then
+    echo "PASS  $2"
+    ((PASSCOUNT++))
+  else
+    echo "FAIL  $2"
+    ((FAILCOUNT++))
+  fi
+}
+
+while getopts "n:" x; do
+  case "$x" in
+    n) ROWS="$OPTARG";;
+    *) echo "Bad args"; exit 1;;
+  esac
+done
+shift $((OPTIND-1))
+EXTRACTION="${1:+`realpath "$1"`}"
+
+BASEDIR="`dirname $0`"
+mkdir "$BASEDIR"/output/years_at_sea || { echo "`realpath ${BASEDIR}`/output/years_at_sea already exists: please remove and retry" 2>&1; exit 1; }
+cd $BASEDIR
+FIXTURES=qtest_pen/extracttest
+OUTDIR=output/years_at_sea
+
+#Golden test: clean_extraction.py on the fixture gives the known-good output
+cp $FIXTURES/test18619.csv $OUTDIR/
+../clean_extraction.py --workflow_defs ../workflow.yaml $OUTDIR/test18619.csv 18619 > $OUTDIR/test18619_stdout
+diff -q $FIXTURES/test18619_stdout.golden $OUTDIR/test18619_stdout > /dev/null && diff -q $FIXTURES/test18619.golden.csv $OUTDIR/test18619.cleaned.csv > /dev/null
+result $? "golden test18619"
+
+#Equivalence and benchmark: the bulk and per-value cleaners agree on the fixture and on a full-size extraction
+PYTHONPATH=.. python3 - $FIXTURES/test18619.csv "$EXTRACTION" $ROWS <<'EOF'
+import sys
+import time
+import pandas as pd
+import clean_extraction
+
+def read(fnam):
+  return pd.read_csv(fnam, usecols = ['data.text'], dtype = str, keep_default_na = False, skip_blank_lines = False)['data.text']
+
+fixture = read(sys.argv[1])
+if sys.argv[2]: values = read(sys.argv[2])
+else: values = pd.Series(list(fixture) * (int(sys.argv[3]) // len(fixture) + 1)).head(int(sys.argv[3]))
+
+failed = 0
+for name, x in (('fixture', fixture), ('extraction', values)):
+  start = time.perf_counter()
+  expected = x.map(clean_extraction.clean_18619)
+  per_value = time.perf_counter() - start
+  start = time.perf_counter()
+  actual = clean_extraction.clean_18619_bulk(x)
+  bulk = time.perf_counter() - start
+  mismatches = x[expected.values != actual.values]
+  if len(mismatches):
+    print(f'{len(mismatches)} of {len(x)} {name} values differ, for example:', file = sys.stderr)
+    for value in mismatches.head(10): print(f'  {value!r}: {clean_extraction.clean_18619(value)!r} vs {clean_extraction.clean_18619_bulk([value])[0]!r}', file = sys.stderr)
+    failed = 1
+  print(f'{name}: {len(x)} rows, per-value {per_value:.3f}s, bulk {bulk:.3f}s ({per_value / bulk:.1f}x)')
+sys.exit(failed)
+EOF
+result $? "bulk cleaner matches per-value cleaner"
+
+echo "Passed $PASSCOUNT of $((PASSCOUNT + FAILCOUNT)) tests"
+exit $FAILCOUNT